@@ -0,0 +1,78 @@
+"""Token-budgeted packing of the background contexts of a planner prompt.
+
+The retrieved (rag) or trimmed (cdit) contexts of an instruction are ranked by
+retrieval score, near-duplicates of a context already kept are dropped (Jaccard
+similarity of their word sets), and the rest fill the token budget in rank
+order. Contexts without a score keep the order they come in, which is the
+retrieval order of the trimmed evidences.
+
+Words keep their negation marker, so `~On_Chips_Table3` and `On_Chips_Table3`
+differ, and two contexts are only duplicates if their goal lines (their last
+line) are the same: an instruction with the opposite goal is always kept.
+"""
+import re
+
+from robot.LLM.prompting import token_counter
+
+_word = re.compile(r"~?\w+")
+
+
+def jaccard(words1, words2):
+    if not words1 and not words2:
+        return 1.0
+    return len(words1 & words2) / len(words1 | words2)
+
+
+class ContextPacker():
+
+    def __init__(self, budget=None, count_tokens=None, dedup_threshold=0.8, max_contexts=None):
+        # budget in tokens for all the contexts of a prompt, None for no limit
+        self.budget = budget
+        self.count_tokens = count_tokens or token_counter()
+        self.dedup_threshold = dedup_threshold
+        self.max_contexts = max_contexts
+        self.totals = {"prompts": 0, "contexts_in": 0, "contexts_kept": 0, "duplicates": 0, "over_budget": 0,
+                       "tokens_in": 0, "tokens_kept": 0}
+
+    @staticmethod
+    def signature(text):
+        """(goal line, word set) of a context, compared to find duplicates."""
+        lines = text.strip().splitlines()
+        goal = " ".join(lines[-1].split()) if lines else ""
+        return goal, set(_word.findall(text.lower()))
+
+    def pack(self, contexts):
+        """The texts of (text, score) `contexts` to put in a prompt, best first."""
+        ranked = sorted(enumerate(contexts),
+                        key=lambda item: (item[1][1] is None, -(item[1][1] or 0.0), item[0]))
+        kept, kept_signatures = [], []
+        used = 0
+        self.totals["prompts"] += 1
+        for _, (text, _) in ranked:
+            tokens = self.count_tokens(text)
+            self.totals["contexts_in"] += 1
+            self.totals["tokens_in"] += tokens
+            goal, words = self.signature(text)
+            if self.dedup_threshold is not None and \
+                    any(goal == other_goal and jaccard(words, other_words) >= self.dedup_threshold
+                        for other_goal, other_words in kept_signatures):
+                self.totals["duplicates"] += 1
+                continue
+            if (self.budget is not None and used + tokens > self.budget) or \
+                    (self.max_contexts is not None and len(kept) >= self.max_contexts):
+                self.totals["over_budget"] += 1
+                continue
+            kept.append(text)
+            kept_signatures.append((goal, words))
+            used += tokens
+        self.totals["contexts_kept"] += len(kept)
+        self.totals["tokens_kept"] += used
+        return kept
+
+    def report(self):
+        totals = dict(self.totals)
+        totals["tokens_saved"] = totals["tokens_in"] - totals["tokens_kept"]
+        totals["tokens_saved_ratio"] = round(totals["tokens_saved"] / totals["tokens_in"], 4) if totals["tokens_in"] else 0.0
+        if totals["prompts"]:
+            totals["mean_tokens_kept"] = round(totals["tokens_kept"] / totals["prompts"], 1)
+        return totals
@@ -1,7 +1,16 @@
-from sympy import symbols, Not, Or, And, to_dnf
-from sympy import symbols, simplify_logic
-
 import re
+import keyword
+from functools import lru_cache
+
+from robot.LLM.dataset.goal_parser import (MAX_VARIABLES, TOO_MANY_VARIABLES, GoalSyntaxError, goal_dnf,
+                                           goal_variables, parse_goal)
+
+# sympy is only needed for formulas outside the goal grammar
+try:
+    import sympy
+    from sympy import to_dnf
+except ImportError:
+    sympy = None
 
 split_characters = r'[()&|~ ]'
 
@@ -35,8 +44,112 @@ dic_pred_obj['Closed'] = ['Curtain', 'AC', 'TubeLight', 'HallLight']
 dic_pred_obj['Low'] = ['ACTemperature']
 dic_pred_obj['High'] = ['ACTemperature']
 
+# lookup tables
+predicate_set = frozenset(predicate_list)
+object_set = frozenset(object_list)
+pred_obj_sets = {predicate: frozenset(objects) for predicate, objects in dic_pred_obj.items()}
+
+
+@lru_cache(maxsize=65536)
+def _needs_sympy(result):
+    """Whether sympy would read `result` differently from the goal grammar, e.g. a
+    name it defines such as E or Not, or syntax the grammar does not have."""
+    if sympy is None:
+        return False
+    try:
+        parse_goal(result)
+    except GoalSyntaxError:
+        return True
+    return any(name in _sympy_names() for name in re.findall(r'[A-Za-z_][A-Za-z0-9_]*', result))
+
+
+@lru_cache(maxsize=1)
+def _sympy_names():
+    return frozenset(name for name in dir(sympy) if not name.startswith('_')) | frozenset(keyword.kwlist)
+
+
+@lru_cache(maxsize=65536)
+def check_word(sentence):
+    """Errors of one predicate such as On_Chips_Table3:
+    (wrong format, wrong predicate or None, wrong objects)."""
+    word_list = re.split('_|~', sentence)
+    word_list = [word for word in word_list if word]
+    if len(word_list) <= 1:
+        return True, None, ()
+
+    predicate = word_list[0]
+    wrong_format = False
+    wrong_objects = []
+    for object in word_list[1:]:
+        if object not in object_set:
+            wrong_objects.append(object)
+        elif predicate in pred_obj_sets and predicate in predicate_set \
+                and object not in pred_obj_sets[predicate]:
+            wrong_format = True
+    return wrong_format, None if predicate in predicate_set else predicate, tuple(wrong_objects)
+
 
 def format_check(result):
+    if _needs_sympy(result):
+        return _sympy_format_check(result)
+    try:
+        # the same failures as sympy's to_dnf(result, simplify=True), without computing the DNF
+        if len(goal_variables(parse_goal(result))) > MAX_VARIABLES:
+            raise ValueError(TOO_MANY_VARIABLES)
+    except ValueError as e:
+        # print("Caught an error:", e)
+        return False, [str(e), None, None, None]
+
+    split_sentences = re.split(split_characters, result)
+    split_sentences = [s.strip() for s in split_sentences if s.strip()]
+
+    wrong_format_set = set()
+    wrong_predicate_set = set()
+    wrong_object_set = set()
+
+    for sentence in split_sentences:
+        wrong_format, wrong_predicate, wrong_objects = check_word(sentence)
+        if wrong_format:
+            wrong_format_set.add(sentence)
+        if wrong_predicate is not None:
+            wrong_predicate_set.add(wrong_predicate)
+        wrong_object_set.update(wrong_objects)
+
+    if len(wrong_format_set) == 0 and \
+            len(wrong_predicate_set) == 0 and \
+            len(wrong_object_set) == 0:
+        return True, None
+    else:
+        return False, [None, wrong_format_set, wrong_predicate_set, wrong_object_set]
+
+
+def _literal_str(name, positive):
+    literal = name
+    if '_' in literal:
+        first_part, rest = literal.split('_', 1)
+        literal = first_part + '(' + rest + ')'
+        literal = literal.replace('_', ',')
+    return literal if positive else 'Not ' + literal
+
+
+@lru_cache(maxsize=65536)
+def _goal_sets(goal):
+    dnf = goal_dnf(goal)
+    if not dnf:
+        return (('False',),)
+    return tuple(tuple(sorted({_literal_str(name, positive) for name, positive in conjunction} or {'True'}))
+                 for conjunction in dnf)
+
+
+def goal_transfer_ls_set(goal):
+    if _needs_sympy(goal):
+        return _sympy_goal_transfer_ls_set(goal)
+    return [list(item) for item in _goal_sets(goal)]
+
+
+# sympy versions, kept for formulas outside the goal grammar
+
+def _sympy_format_check(result):
     try:
         goal_dnf = str(to_dnf(result, simplify=True))
     except Exception as e:
@@ -84,7 +197,7 @@ def format_check(result):
         return False, [None, wrong_format_set, wrong_predicate_set, wrong_object_set]
 
 
-def goal_transfer_ls_set(goal):
+def _sympy_goal_transfer_ls_set(goal):
     goal_dnf = str(to_dnf(goal, simplify=True))
     goal_set = []
     goal_ls = goal_dnf.split("|")
@@ -0,0 +1,316 @@
+"""Parser and DNF conversion for goal formulas such as
+`(On_Chips_Table3 | On_Chips_Table2) & ~Active_AC`.
+
+Formulas are made of predicate names, `~`, `&`, `|` and parentheses, with the
+precedence of the Python operators that sympy parsed them with before. The
+simplest DNF is computed with the same Quine-McCluskey steps as sympy's
+`to_dnf(..., simplify=True)`, over the truth table of the formula, so the
+results match it. Parses and DNFs are memoized on the formula text.
+"""
+import re
+import keyword
+import itertools
+from functools import lru_cache
+
+# sympy refuses to simplify formulas over more variables than this
+MAX_VARIABLES = 8
+TOO_MANY_VARIABLES = ("\nTo simplify a logical expression with more than 8 variables may take a\n"
+                      "long time and requires the use of `force=True`.")
+
+# only ASCII separators: other whitespace such as \xa0 is a syntax error for sympy,
+# so those formulas are left to it
+_separators = ' \t\r\n'
+_token_pattern = re.compile(r'[ \t\r\n]*(?:([A-Za-z_][A-Za-z0-9_]*)|(.))', re.DOTALL)
+_constants = {'True': True, 'False': False}
+
+
+class GoalSyntaxError(ValueError):
+    pass
+
+
+def tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip(_separators)
+    while position < len(text):
+        match = _token_pattern.match(text, position)
+        name, op = match.groups()
+        if name is not None:
+            if keyword.iskeyword(name) and name not in _constants:
+                raise GoalSyntaxError(f"invalid syntax: reserved word {name!r}")
+            tokens.append(('name', name))
+        elif op in '&|~()':
+            tokens.append(('op', op))
+        else:
+            raise GoalSyntaxError(f"invalid character {op!r}")
+        position = match.end()
+    return tokens
+
+
+class _Parser(object):
+    """expr := and ('|' and)* ; and := unary ('&' unary)* ; unary := '~' unary | atom"""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self):
+        token = self.peek()
+        self.position += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise GoalSyntaxError("empty formula")
+        node = self.expr()
+        if self.position != len(self.tokens):
+            raise GoalSyntaxError(f"unexpected {self.peek()[1]!r}")
+        return node
+
+    def expr(self):
+        nodes = [self.conjunction()]
+        while self.peek() == ('op', '|'):
+            self.take()
+            nodes.append(self.conjunction())
+        return nodes[0] if len(nodes) == 1 else ('or', tuple(nodes))
+
+    def conjunction(self):
+        nodes = [self.unary()]
+        while self.peek() == ('op', '&'):
+            self.take()
+            nodes.append(self.unary())
+        return nodes[0] if len(nodes) == 1 else ('and', tuple(nodes))
+
+    def unary(self):
+        if self.peek() == ('op', '~'):
+            self.take()
+            return ('not', self.unary())
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.take()
+        if kind == 'name':
+            if value in _constants:
+                return ('const', _constants[value])
+            return ('var', value)
+        if (kind, value) == ('op', '('):
+            node = self.expr()
+            if self.take() != ('op', ')'):
+                raise GoalSyntaxError("missing ')'")
+            return node
+        raise GoalSyntaxError("unexpected end of formula" if kind is None else f"unexpected {value!r}")
+
+
+@lru_cache(maxsize=65536)
+def parse_goal(text):
+    """AST of a goal formula: ('var', name), ('const', bool), ('not', node),
+    ('and', nodes) or ('or', nodes). Raises GoalSyntaxError."""
+    return _Parser(tokenize(text)).parse()
+
+
+def goal_variables(node):
+    if node[0] == 'var':
+        return {node[1]}
+    if node[0] == 'const':
+        return set()
+    if node[0] == 'not':
+        return goal_variables(node[1])
+    return set().union(*(goal_variables(child) for child in node[1]))
+
+
+def _compile(node, index):
+    """A function of a tuple of 0/1 values, evaluating `node`."""
+    kind = node[0]
+    if kind == 'var':
+        i = index[node[1]]
+        return lambda bits: bits[i]
+    if kind == 'const':
+        value = node[1]
+        return lambda bits: value
+    if kind == 'not':
+        child = _compile(node[1], index)
+        return lambda bits: not child(bits)
+    children = [_compile(child, index) for child in node[1]]
+    if kind == 'and':
+        return lambda bits: all(child(bits) for child in children)
+    return lambda bits: any(child(bits) for child in children)
+
+
+def _check_pair(term1, term2):
+    """Index of the only position where the terms differ, -1 otherwise."""
+    index = -1
+    for x, value in enumerate(term1):
+        if value != term2[x]:
+            if index != -1:
+                return -1
+            index = x
+    return index
+
+
+def _simplified_pairs(terms):
+    """Merge terms differing in one position into terms with a don't care (3),
+    repeatedly, and return the prime implicants."""
+    if not terms:
+        return []
+    simplified = []
+    seen = set()
+    todo = list(range(len(terms)))
+    by_ones = {}
+    for n, term in enumerate(terms):
+        by_ones.setdefault(sum(1 for t in term if t == 1), []).append(n)
+    for k in range(len(terms[0])):
+        for i in by_ones.get(k, []):
+            for j in by_ones.get(k + 1, []):
+                index = _check_pair(terms[i], terms[j])
+                if index != -1:
+                    todo[i] = todo[j] = None
+                    new_term = terms[i][:]
+                    new_term[index] = 3
+                    if tuple(new_term) not in seen:
+                        seen.add(tuple(new_term))
+                        simplified.append(new_term)
+    if simplified:
+        simplified = _simplified_pairs(simplified)
+    simplified.extend(terms[i] for i in todo if i is not None)
+    return simplified
+
+
+def _bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def _rem_redundancy(primes, terms):
+    """Keep a cover of `terms` by `primes`, removing dominated rows and columns of
+    the prime implicant table, then greedily picking the widest prime.
+
+    Rows and columns of the table are bitsets, the order of the removals is
+    the one of sympy's _rem_redundancy.
+    """
+    if not terms:
+        return []
+    n_terms, n_primes = len(terms), len(primes)
+    rows = [0] * n_terms
+    col_count = [0] * n_primes
+    row_count = [0] * n_terms
+    for p, prime in enumerate(primes):
+        for t, term in enumerate(terms):
+            if all(x == 3 or x == y for x, y in zip(prime, term)):
+                rows[t] |= 1 << p
+                col_count[p] += 1
+                row_count[t] += 1
+
+    def remove(t, p):
+        rows[t] &= ~(1 << p)
+        row_count[t] -= 1
+        col_count[p] -= 1
+
+    changed = True
+    while changed:
+        changed = False
+        for r in range(n_terms):
+            if row_count[r]:
+                row = rows[r]
+                for r2 in range(n_terms):
+                    if r != r2 and row_count[r] and row_count[r] <= row_count[r2] and rows[r2] & row == row:
+                        # r2 dominates r
+                        row_count[r2] = 0
+                        changed = True
+                        for p in _bits(rows[r2]):
+                            col_count[p] -= 1
+                        rows[r2] = 0
+
+        # columns are read once per pass, like sympy's column cache
+        columns = {}
+
+        def column(c):
+            if c not in columns:
+                columns[c] = sum(1 << t for t in range(n_terms) if rows[t] >> c & 1)
+            return columns[c]
+
+        for c in range(n_primes):
+            if col_count[c]:
+                col = column(c)
+                for c2 in range(n_primes):
+                    if c != c2 and col_count[c2] and col_count[c] >= col_count[c2]:
+                        col2 = column(c2)
+                        if col | col2 == col:
+                            # c dominates c2
+                            col_count[c2] = 0
+                            changed = True
+                            for t in _bits(col2):
+                                if rows[t] >> c2 & 1:
+                                    rows[t] &= ~(1 << c2)
+                                    row_count[t] -= 1
+
+        if not changed:
+            best, best_count = -1, 0
+            for c in range(n_primes):
+                if col_count[c] > best_count:
+                    best, best_count = c, col_count[c]
+            if best != -1 and best_count > 1:
+                for p in range(n_primes):
+                    if p != best:
+                        for t in _bits(columns[best]):
+                            if rows[t] >> p & 1:
+                                remove(t, p)
+                                changed = True
+
+    return [primes[p] for p in range(n_primes) if col_count[p]]
+
+
+def _flatten(node):
+    """Merge nested conjunctions and disjunctions and cancel double negations,
+    as sympy does when it builds the expression."""
+    kind = node[0]
+    if kind == 'not':
+        child = _flatten(node[1])
+        return child[1] if child[0] == 'not' else ('not', child)
+    if kind in ('and', 'or'):
+        children = []
+        for child in map(_flatten, node[1]):
+            children.extend(child[1] if child[0] == kind else [child])
+        return (kind, tuple(children))
+    return node
+
+
+def _literal(node):
+    if node[0] == 'var':
+        return node[1], True
+    if node[0] == 'not' and node[1][0] == 'var':
+        return node[1][1], False
+    return None
+
+
+@lru_cache(maxsize=65536)
+def goal_dnf(text):
+    """Simplest DNF of a goal formula, as a tuple of conjunctions of (name, positive)
+    literals. () is False and ((),) is True. Raises GoalSyntaxError, or ValueError
+    for formulas over more than MAX_VARIABLES variables."""
+    node = parse_goal(text)
+    names = sorted(goal_variables(node))
+    if len(names) > MAX_VARIABLES:
+        raise ValueError(TOO_MANY_VARIABLES)
+    # sympy returns a conjunction or disjunction of literals as it is
+    node = _flatten(node)
+    if _literal(node) is not None:
+        return ((_literal(node),),)
+    if node[0] in ('and', 'or'):
+        literals = [_literal(child) for child in node[1]]
+        if all(literal is not None for literal in literals):
+            literals = list(dict.fromkeys(literals))
+            return (tuple(literals),) if node[0] == 'and' else tuple((literal,) for literal in literals)
+    function = _compile(node, {name: i for i, name in enumerate(names)})
+    minterms = [list(bits) for bits in itertools.product((0, 1), repeat=len(names)) if function(bits)]
+    if not minterms:
+        return ()
+    primes = _rem_redundancy(_simplified_pairs(minterms), minterms)
+    return tuple(
+        tuple((name, value == 1) for name, value in zip(names, prime) if value != 3)
+        for prime in primes
+    )
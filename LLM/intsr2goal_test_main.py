@@ -1,22 +1,33 @@
+import os
 import csv
 import re
 import json
+import asyncio
+import hashlib
 import numpy as np
-import concurrent.futures
 from itertools import chain
 from vllm import LLM, SamplingParams
-from robot.LLM.llms.gpt3 import LLMGPT3
+from robot.LLM.llms.gpt3 import LLMGPT3, AsyncLLMGPT3
+from robot.LLM.result_sink import ResultSink
+from robot.LLM.prompting import PromptBuilder, token_counter
+from robot.LLM.context_packer import ContextPacker
 from robot.LLM.dataset.data_process_check import format_check, goal_transfer_ls_set
 
 
-def init_csv(filename, max_feedbacks=5):
-    """Initialize a CSV file and write the header row, which includes multiple outputs and feedbacks."""
+def csv_headers(max_feedbacks=5):
+    """The header row, which includes multiple outputs and feedbacks."""
     headers = ['ID', 'Instruction', 'Correct Goal']
     for i in range(max_feedbacks + 1):
         headers.append(f'Model Output {i + 1}')
         if i < max_feedbacks:
             headers.append(f'Feedback Given {i + 1}')
     headers.extend(['Feedback Count', 'Grammar Correct', 'Content Correct'])
+    return headers
+
+
+def init_csv(filename, max_feedbacks=5):
+    """Initialize a CSV file and write the header row, which includes multiple outputs and feedbacks."""
+    headers = csv_headers(max_feedbacks)
     print("headers:", headers)
     with open(filename, 'w', newline='', encoding='utf-8') as file:
         writer = csv.writer(file)
@@ -172,8 +183,14 @@ def call_model(prompts, model, max_new_tokens=50):
     #postprocessed_preds = [postprocess_output(pred) for pred in preds]
     return  preds
 
-def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, id):
-    """ Process a single section of the dataset and return detailed results for further processing. """
+def section_rounds(prompt, section, prompt_rag, mode, prompt2, id, builder=None, packer=None):
+    """ The feedback loop of a single section, as a generator: it yields the messages of
+    each round, is sent the model's answer, and returns (results, data_record).
+    The prompt is assembled once by `builder`, a PromptBuilder, which counts its tokens,
+    and the background contexts are ranked, deduplicated and cut to a token budget by
+    `packer`, a ContextPacker, if given. """
+    if builder is None:
+        builder = PromptBuilder(prompt2=prompt2)
     results = {f'GA-{f}F': [] for f in range(6)}
     results.update({f'IA-{f}F': [] for f in range(6)})
 
@@ -182,9 +199,14 @@ def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, i
     correct_answer = y.strip().replace("Goal: ", "")
     background=[]
     if mode == 'rag':
-        background=["[{}]".format(i + 1) + "Instruction:" + ctx["title"] + "\n" + ctx["text"] for i, ctx in enumerate(prompt_rag['ctxs'])]
+        contexts=[(ctx["title"] + "\n" + ctx["text"], float(ctx["score"]) if "score" in ctx else None) for ctx in prompt_rag['ctxs']]
+        if packer is not None:
+            contexts=[(text, None) for text in packer.pack(contexts)]
+        background=["[{}]".format(i + 1) + "Instruction:" + text for i, (text, _) in enumerate(contexts)]
     elif mode=='cdit':
         background=prompt_rag['ctxs']
+        if packer is not None:
+            background=packer.pack([(ctx, None) for ctx in background])
         question=prompt_rag['question']
     background_rag='[Background]\n'
     for back in background:
@@ -199,14 +221,15 @@ def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, i
     grammar_correct = False
     content_correct = False
 
+    # the same prompt is sent on every round
+    full_prompt = builder.build(prompt, question, None if mode == 'base' else background_rag)
+
     # Modified evaluate_responses logic here, focusing on single section
     while feedback_time <= 5:
-        if mode=='base':
-            messages = [{"role": "user", "content": prompt + "\n" + prompt2 + '\n' + question}]
-        else:
-            messages = [{"role": "user", "content": prompt + "\n" +background_rag + '\n'+ prompt2 + '\n' + question}]
+        messages = [{"role": "user", "content": full_prompt.text}]
         #print(messages)
-        answer = llm.request(message=messages)
+        builder.record(full_prompt)
+        answer = yield messages
         messages.append({"role": "assistant", "content": answer})
         print_colored(f"id:{id}  {feedback_time}th Answer: {answer}  Q:{question}","yellow")
 
@@ -242,6 +265,112 @@ def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, i
 
     return results, data_record
 
+
+def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, id):
+    """ Process a single section of the dataset and return detailed results for further processing. """
+    rounds = section_rounds(prompt, section, prompt_rag, mode, prompt2, id)
+    try:
+        messages = next(rounds)
+        while True:
+            messages = rounds.send(llm.request(message=messages))
+    except StopIteration as stop:
+        return stop.value
+
+
+async def aevaluate_section(llm, prompt, section, prompt_rag, mode, prompt2, id, builder=None, packer=None):
+    """ Like evaluate_section, awaiting the answers of an AsyncLLMGPT3. """
+    rounds = section_rounds(prompt, section, prompt_rag, mode, prompt2, id, builder, packer)
+    try:
+        messages = next(rounds)
+        while True:
+            messages = rounds.send(await llm.arequest(message=messages))
+    except StopIteration as stop:
+        return stop.value
+
+
+class ShotResults():
+    """ Results of one (try, difficulty, shots) setting, gathered as its sections complete.
+
+    Each completed section is written right away to the setting's CSV and JSONL files
+    through a ResultSink, which checkpoints the finished section ids. With `resume`,
+    the checkpointed sections are counted back in from the CSV and not run again,
+    if they were written with the same `fingerprint` of the settings.
+    """
+
+    def __init__(self, csv_filename, resume=False, fingerprint=None):
+        self.results = {f'GA-{f}F': [] for f in range(6)}
+        self.results.update({f'IA-{f}F': [] for f in range(6)})
+        self.done = set()
+        self.sink = ResultSink(csv_filename, csv_headers(), jsonl_path=os.path.splitext(csv_filename)[0] + '.jsonl',
+                               resume=resume, fingerprint=fingerprint)
+        if self.sink.done:
+            # the files end at the last checkpoint, every row in them is complete
+            with open(csv_filename, 'r', newline='', encoding='utf-8') as file:
+                reader = csv.reader(file)
+                next(reader, None)
+                for data_record in reader:
+                    if data_record:
+                        self.add(self.record_results(data_record), data_record, write=False)
+            print_colored(f"Resuming {csv_filename}: {len(self.done)} sections done", "blue")
+
+    @staticmethod
+    def record_results(data_record):
+        """ The GA/IA results of a section, rebuilt from its CSV row. """
+        feedback_time = int(data_record[-3])
+        grammar_correct = data_record[-2] == 'True'
+        content_correct = data_record[-1] == 'True'
+        results = {}
+        for f in range(6):
+            passed = grammar_correct and f >= feedback_time
+            results[f'GA-{f}F'] = [1 if passed else 0]
+            results[f'IA-{f}F'] = [1 if passed and content_correct else 0]
+        return results
+
+    def add(self, results, data_record, write=True):
+        for key in self.results:
+            self.results[key].extend(results[key])
+        self.done.add(int(data_record[0]))
+        if write:
+            self.sink.write(data_record[0], data_record)
+
+    def close(self):
+        self.sink.close()
+
+
+def settings_fingerprint(*settings):
+    """ A short hash of the settings a results file was written with. """
+    content = json.dumps(settings, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:16]
+
+
+async def run_sweep(llm, jobs, shot_results, max_sections):
+    """ Evaluate all the jobs, (setting key, section arguments), from one work queue.
+
+    `max_sections` sections are in progress at once, whatever their difficulty, shots
+    and feedback round, so the sweep is bound by the client's request limits rather than
+    by the slowest section of each setting. A section whose request still fails after
+    the client's retries is reported and left out, a resumed run evaluates it again.
+    """
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    failed = []
+
+    async def worker():
+        while not queue.empty():
+            key, args = queue.get_nowait()
+            try:
+                results, data_record = await aevaluate_section(llm, *args)
+            except Exception as e:
+                print_colored(f"{key} id:{args[5]} failed: {e!r}", "red")
+                failed.append((key, args[5]))
+                continue
+            shot_results[key].add(results, data_record)
+
+    await asyncio.gather(*[worker() for _ in range(min(max_sections, len(jobs)))])
+    return failed
+
+
 def load_data(data_path):
     if data_path.endswith(".json"):
         #with open(data_path, "r",encoding='utf-8') as fin:
@@ -287,80 +416,71 @@ if __name__ == "__main__":
     prompt3_data=[]
 
     # Initialize data structures and loop through experiment iterations
-    llm = LLMGPT3()
+    # pooled client with bounded concurrency, rate limiting and retries; LLMGPT3() for plain sequential calls
+    llm = AsyncLLMGPT3(max_in_flight=16, requests_per_second=None, timeout=60.0, max_retries=5)
 
     max_try_time = 1
     difficulties = ["medium"]  # Can be expanded to ["easy", "medium", "hard"]
     num_examples = [0,1,2,3,4,5]
     mode='cdit' # base,rag,cdit
 
+    # sections evaluated at once across all settings; resume continues the sweep from its CSV files
+    # when they were written with the same mode, model, prompts and data
+    max_sections = 4 * llm.max_in_flight
+    resume = False
+
     if mode == 'rag':
         prompt3_data=prompt_rag
     elif mode == 'cdit':
         prompt3_data=prompt_rag_cdit
 
-    all_results = {}
+    # system prompts built once per setting, prompt tokens counted with the model's tokenizer
+    builder = PromptBuilder(generate_prompt1, prompt2, count_tokens=token_counter(llm.model))
+    # all the background contexts are used; to rank them by score, drop near-duplicates and keep them
+    # within a token budget:
+    # packer = ContextPacker(budget=1024, count_tokens=builder.count_tokens, dedup_threshold=0.8)
+    packer = None
+
+    # one (try, difficulty, shots) setting per CSV file
+    datasets = {"easy": easy_data_set, "medium": medium_data_set, "hard": hard_data_set}
+    data_fingerprint = settings_fingerprint(prompt3_data)
+    shot_results = {}
+    jobs = []
+    for try_time in range(max_try_time):
+        for difficulty in difficulties:
+            sections = re.split(r'\n\s*\n', datasets[difficulty])[:]
+            for num in num_examples:
+                key = (try_time, difficulty, num)
+                prompt = builder.prefix(num, difficulty)
+
+                # record
+                csv_filename = f"details_{mode}_{difficulty}_shot={num}_t={try_time}.csv"
+                fingerprint = settings_fingerprint(mode, llm.model, prompt, prompt2, datasets[difficulty], data_fingerprint,
+                                                   packer and (packer.budget, packer.dedup_threshold, packer.max_contexts))
+                shot_results[key] = ShotResults(csv_filename, resume=resume, fingerprint=fingerprint)
+
+                for id, section in enumerate(sections):
+                    if id not in shot_results[key].done:
+                        prompt_rag = '' if mode == 'base' else prompt3_data[id]
+                        jobs.append((key, (prompt, section, prompt_rag, mode, prompt2, id, builder, packer)))
+
+    print_colored(f"{len(jobs)} sections to evaluate, at most {max_sections} at once", "blue")
+    try:
+        failed = llm.run(run_sweep(llm, jobs, shot_results, max_sections))
+    finally:
+        for results in shot_results.values():
+            results.close()
+    if failed:
+        print_colored(f"{len(failed)} sections failed, rerun to evaluate them: {failed}", "red")
+
+    all_results = {difficulty: {num: [] for num in num_examples} for difficulty in difficulties}
     for try_time in range(max_try_time):
         print_colored(f'=============== Time {try_time} ===============',"blue")
         for difficulty in difficulties:
             print_colored(f"-----------------------{difficulty}-------------------------","blue")
-
-            for diff in difficulties:
-                if diff not in all_results:
-                    all_results[diff] = {num: [] for num in num_examples}
-
-            data_set = easy_data_set
-            if difficulty == "medium":
-                data_set = medium_data_set
-            elif difficulty == "hard":
-                data_set = hard_data_set
-
-            sections = re.split(r'\n\s*\n', data_set)[:]
             results_table = []
-            '''
-            sections_rag=[]
-            for k,ctx in enumerate(sections):
-                background=["[{}]".format(i + 1) + "Instruction:" + ctx["title"] + "\n" + ctx["text"] for i, ctx in
-                 enumerate(prompt3_data[k]['ctxs'])]
-                ctx+='[Background]: '
-                for ct in background:
-                    ctx+=ct
-                sections_rag.append(ctx)
-            '''
             for num in num_examples:
-                feedback_type = "Zero-shot" if num == 0 else f"Few-shot {num}"
-                print_colored(f'=============== Feedback Level {feedback_type} ===============',"blue")
-
-                # record
-                csv_filename = f"details_{difficulty}_shot={num}_t={try_time}.csv"
-                init_csv(csv_filename)
-
-                prompt = generate_prompt1(num, difficulty)
-
-                all_data_records = []
-                with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-                    if mode == 'base':
-                        futures = {executor.submit(evaluate_section, prompt, section, '',mode, prompt2, csv_filename,
-                                                   id): section for id, section
-                                   in
-                                   enumerate(sections)}
-                    else:
-                        futures = {executor.submit(evaluate_section, prompt, section, prompt3_data[id], mode, prompt2, csv_filename, id): section for id, section
-                               in
-                               enumerate(sections)}
-                    results = {f'GA-{f}F': [] for f in range(6)}
-                    results.update({f'IA-{f}F': [] for f in range(6)})
-
-                    for future in concurrent.futures.as_completed(futures):
-                        evaluation_results, data_record = future.result()
-                        for key in results:
-                            results[key].extend(evaluation_results[key])
-                        all_data_records.append(data_record)
-
-                # Bulk write to CSV
-                for data_record in all_data_records:
-                    append_to_csv(csv_filename, data_record)
-
+                results = shot_results[(try_time, difficulty, num)].results
                 filtered_keys = ['GA-0F', 'GA-1F', 'GA-5F', 'IA-0F', 'IA-1F', 'IA-5F']
                 row = {key: f'{key}: {np.mean(results[key]):.2%}' for key in filtered_keys if key in results}
                 results_table.append(row)
@@ -393,3 +513,8 @@ if __name__ == "__main__":
                 print(f"Zero-shot\t{row_data}")
             else:
                 print(f"Few-shot-{num}\t{row_data}")
+
+    print("LLM response cache:", llm.cache.stats())
+    print("Prompt tokens per request:", builder.report())
+    if packer is not None:
+        print("Background packing:", packer.report())
@@ -2,10 +2,12 @@ import csv
 import re
 import json
 import numpy as np
-import concurrent.futures
 from itertools import chain
 from vllm import LLM, SamplingParams
 from robot.LLM.llms.gpt3 import LLMGPT3
+from robot.LLM.llms.vllm_backend import VLLMBackend, MockLLM, run_batched
+from robot.LLM.prompting import PromptBuilder, token_counter
+from robot.LLM.context_packer import ContextPacker
 from robot.LLM.dataset.data_process_check import format_check, goal_transfer_ls_set
 
 
@@ -172,8 +174,19 @@ def call_model(prompts, model, max_new_tokens=50):
     #postprocessed_preds = [postprocess_output(pred) for pred in preds]
     return preds
 
-def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, id):
-    """ Process a single section of the dataset and return detailed results for further processing. """
+def call_model_batch(messages_list, backend):
+    """ Answers to many conversations in one batched generation, post-processed like call_model. """
+    preds = backend.generate([messages[0]['content'] for messages in messages_list])
+    return [pred.split("\n")[0] for pred in preds]
+
+def section_rounds(prompt, section, prompt_rag, mode, prompt2, id, builder=None, packer=None):
+    """ The feedback loop of a single section, as a generator: it yields the messages of
+    each round, is sent the model's answer, and returns (results, data_record).
+    The prompt is assembled once by `builder`, a PromptBuilder, which counts its tokens,
+    and the background contexts are ranked, deduplicated and cut to a token budget by
+    `packer`, a ContextPacker, if given. """
+    if builder is None:
+        builder = PromptBuilder(prompt2=prompt2, suffix="\nGoal: ")
     results = {f'GA-{f}F': [] for f in range(6)}
     results.update({f'IA-{f}F': [] for f in range(6)})
 
@@ -182,9 +195,14 @@ def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, i
     correct_answer = y.strip().replace("Goal: ", "")
     background=[]
     if mode == 'rag':
-        background=["[{}]".format(i + 1) + "Instruction: " + ctx["title"] + "\n" +"Goal: " + ctx["text"] for i, ctx in enumerate(prompt_rag['ctxs'])]
+        contexts=[(ctx["title"] + "\n" +"Goal: " + ctx["text"], float(ctx["score"]) if "score" in ctx else None) for ctx in prompt_rag['ctxs']]
+        if packer is not None:
+            contexts=[(text, None) for text in packer.pack(contexts)]
+        background=["[{}]".format(i + 1) + "Instruction: " + text for i, (text, _) in enumerate(contexts)]
     elif mode=='cdit':
         background=prompt_rag['ctxs']
+        if packer is not None:
+            background=packer.pack([(ctx, None) for ctx in background])
         question=prompt_rag['question']
     background_rag='[Related Demonstrations]\n'
     for back in background:
@@ -199,16 +217,17 @@ def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, i
     grammar_correct = False
     content_correct = False
 
+    # the same prompt is sent on every round
+    full_prompt = builder.build(prompt, question, None if mode == 'base' else background_rag)
+
     # Modified evaluate_responses logic here, focusing on single section
     while feedback_time <= 5:
-        if mode=='base':
-            messages = [{"role": "user", "content": prompt + "\n" + prompt2 + '\n' + question + "\nGoal: "}]
-        else:
-            messages = [{"role": "user", "content": prompt + "\n" +background_rag + '\n'+ prompt2 + '\n' + question + "\nGoal: "}]
+        messages = [{"role": "user", "content": full_prompt.text}]
         #print(messages)
+        builder.record(full_prompt)
         #answer = llm.request(message=messages)
         #answer = llm.request(message=messages)
-        answer = call_model(messages, model=model,max_new_tokens=100)
+        answer = yield messages
         messages.append({"role": "assistant", "content": answer})
         print_colored(f"id:{id}  {feedback_time}th Answer: {answer}  Q:{question}","yellow")
 
@@ -243,6 +262,16 @@ def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, i
 
     return results, data_record
 
+def evaluate_section(prompt, section, prompt_rag, mode, prompt2, csv_filename, id):
+    """ Process a single section of the dataset and return detailed results for further processing. """
+    rounds = section_rounds(prompt, section, prompt_rag, mode, prompt2, id)
+    try:
+        messages = next(rounds)
+        while True:
+            messages = rounds.send(call_model_batch([messages], backend)[0])
+    except StopIteration as stop:
+        return stop.value
+
 def load_data(data_path):
     if data_path.endswith(".json"):
         #with open(data_path, "r",encoding='utf-8') as fin:
@@ -293,7 +322,11 @@ if __name__ == "__main__":
     # Initialize data structures and loop through experiment iterations
     #llm = LLMGPT3()
 
-    model = LLM(model=model_name, download_dir=download_dir,tensor_parallel_size=1, trust_remote_code=True,)
+    # prompts of all sections are generated in batches, sharing the system prompt through prefix caching
+    backend = VLLMBackend(model=model_name, download_dir=download_dir, max_new_tokens=100,
+                          enable_prefix_caching=True, tensor_parallel_size=1, trust_remote_code=True)
+    # backend = VLLMBackend(engine=MockLLM())  # without a GPU
+    max_batch = 256
     max_try_time = 5
     difficulties = ["medium"]  # Can be expanded to ["easy", "medium", "hard"]
     num_examples = [0,1,2,3,4,5]
@@ -304,65 +337,60 @@ if __name__ == "__main__":
     elif mode == 'cdit':
         prompt3_data=prompt_rag_cdit
 
-    all_results = {}
+    # system prompts built once per setting, prompt tokens counted with the model's tokenizer
+    builder = PromptBuilder(generate_prompt1, prompt2, suffix="\nGoal: ", count_tokens=token_counter(model_name))
+    # all the background contexts are used; to rank them by score, drop near-duplicates and keep them
+    # within a token budget:
+    # packer = ContextPacker(budget=1024, count_tokens=builder.count_tokens, dedup_threshold=0.8)
+    packer = None
+
+    # every section of every (try, difficulty, shots) setting goes through one batched run
+    datasets = {"easy": easy_data_set, "medium": medium_data_set, "hard": hard_data_set}
+    setting_records = {}
+    setting_results = {}
+    jobs = []
+    for try_time in range(max_try_time):
+        for difficulty in difficulties:
+            sections = re.split(r'\n\s*\n', datasets[difficulty])[:]
+            for num in num_examples:
+                key = (try_time, difficulty, num)
+                setting_records[key] = []
+                setting_results[key] = {f'GA-{f}F': [] for f in range(6)}
+                setting_results[key].update({f'IA-{f}F': [] for f in range(6)})
+                prompt = builder.prefix(num, difficulty)
+                for id, section in enumerate(sections):
+                    prompt_rag = '' if mode == 'base' else prompt3_data[id]
+                    jobs.append((key, section_rounds(prompt, section, prompt_rag, mode, prompt2, id, builder, packer)))
+
+    def on_done(key, result):
+        evaluation_results, data_record = result
+        setting_records[key].append(data_record)
+        for name in setting_results[key]:
+            setting_results[key][name].extend(evaluation_results[name])
+
+    run_batched(lambda messages_list: call_model_batch(messages_list, backend), jobs, on_done, max_batch=max_batch)
+    print_colored(f"vLLM batches: {backend.stats}", "blue")
+    print_colored(f"Prompt tokens per request: {builder.report()}", "blue")
+    if packer is not None:
+        print_colored(f"Background packing: {packer.report()}", "blue")
+
+    all_results = {difficulty: {num: [] for num in num_examples} for difficulty in difficulties}
     for try_time in range(max_try_time):
         print_colored(f'=============== Time {try_time} ===============',"blue")
         for difficulty in difficulties:
             print_colored(f"-----------------------{difficulty}-------------------------","blue")
-
-            for diff in difficulties:
-                if diff not in all_results:
-                    all_results[diff] = {num: [] for num in num_examples}
-
-            data_set = easy_data_set
-            if difficulty == "medium":
-                data_set = medium_data_set
-            elif difficulty == "hard":
-                data_set = hard_data_set
-
-            sections = re.split(r'\n\s*\n', data_set)[:]
             results_table = []
-            '''
-            sections_rag=[]
-            for k,ctx in enumerate(sections):
-                background=["[{}]".format(i + 1) + "Instruction:" + ctx["title"] + "\n" + ctx["text"] for i, ctx in
-                 enumerate(prompt3_data[k]['ctxs'])]
-                ctx+='[Background]: '
-                for ct in background:
-                    ctx+=ct
-                sections_rag.append(ctx)
-            '''
             for num in num_examples:
-                feedback_type = "Zero-shot" if num == 0 else f"Few-shot {num}"
-                print_colored(f'=============== Feedback Level {feedback_type} ===============',"blue")
-
+                key = (try_time, difficulty, num)
                 # record
                 csv_filename = f"details_{difficulty}_shot={num}_t={try_time}.csv"
                 init_csv(csv_filename)
 
-                prompt = generate_prompt1(num, difficulty)
-
-                all_data_records = []
-                results = {f'GA-{f}F': [] for f in range(6)}
-                results.update({f'IA-{f}F': [] for f in range(6)})
-                if mode == 'base':
-                    for id, section in enumerate(sections):
-                        evaluation_results,data_record=evaluate_section(prompt, section, '',mode, prompt2, csv_filename,id)
-                        all_data_records.append(data_record)
-                        for key in results:
-                            results[key].extend(evaluation_results[key])
-                else:
-                    for id, section in enumerate(sections):
-                        evaluation_results,data_record=evaluate_section(prompt, section, prompt3_data[id], mode, prompt2, csv_filename, id)
-                        all_data_records.append(data_record)
-                        for key in results:
-                            results[key].extend(evaluation_results[key])
-
-
                 # Bulk write to CSV
-                for data_record in all_data_records:
+                for data_record in setting_records[key]:
                     append_to_csv(csv_filename, data_record)
 
+                results = setting_results[key]
                 filtered_keys = ['GA-0F', 'GA-1F', 'GA-5F', 'IA-0F', 'IA-1F', 'IA-5F']
                 row = {key: f'{key}: {np.mean(results[key]):.2%}' for key in filtered_keys if key in results}
                 results_table.append(row)
@@ -0,0 +1,125 @@
+"""Persistent cache of LLM responses, keyed on the model, the sampling
+parameters and the full message list.
+
+Modes:
+    rw      answer from the cache, call the model on a miss and store the answer
+    replay  answer from the cache only, a miss raises CacheMiss (no API calls)
+    bypass  always call the model and leave the cache untouched
+
+The default cache is configured with the LLM_CACHE_PATH and LLM_CACHE_MODE
+environment variables (llm_cache.sqlite in the working directory, bypass).
+Caching is opt-in: the planner evaluations sample the same messages on every
+feedback round and every try, and must not get the first answer back. Use rw or
+replay to reproduce a finished run, e.g. LLM_CACHE_MODE=replay.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+MODES = ("rw", "replay", "bypass")
+
+
+class CacheMiss(KeyError):
+    pass
+
+
+class ResponseCache():
+
+    def __init__(self, path="llm_cache.sqlite", mode="rw"):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cache mode {mode}, expected one of {MODES}")
+        self.path = path
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if mode != "bypass":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, model TEXT, response TEXT, created REAL)"
+            )
+            self.db.commit()
+
+    @staticmethod
+    def key(model, messages, params=None):
+        content = json.dumps({"model": model, "params": params or {}, "messages": messages},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        if self.db is None:
+            return None
+        with self.lock:
+            row = self.db.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, model, response):
+        if self.db is None or self.mode != "rw":
+            return
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                            (key, model, json.dumps(response, ensure_ascii=False), time.time()))
+            self.db.commit()
+
+    def call(self, model, messages, params, request):
+        """Return the cached response to `messages`, or the result of `request()`."""
+        if self.mode == "bypass":
+            return request()
+        key = self.key(model, messages, params)
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        self.misses += 1
+        if self.mode == "replay":
+            raise CacheMiss(f"No cached {model} response for {messages[-1]['content'][:80]!r}")
+        response = request()
+        self.put(key, model, response)
+        return response
+
+    async def acall(self, model, messages, params, request):
+        """Like `call`, for a coroutine function `request`."""
+        if self.mode == "bypass":
+            return await request()
+        key = self.key(model, messages, params)
+        response = self.get(key)
+        if response is not None:
+            self.hits += 1
+            return response
+        self.misses += 1
+        if self.mode == "replay":
+            raise CacheMiss(f"No cached {model} response for {messages[-1]['content'][:80]!r}")
+        response = await request()
+        self.put(key, model, response)
+        return response
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"mode": self.mode, "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def default_cache():
+    """The process-wide cache configured by LLM_CACHE_PATH and LLM_CACHE_MODE."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache(
+                os.environ.get("LLM_CACHE_PATH", "llm_cache.sqlite"),
+                os.environ.get("LLM_CACHE_MODE", "bypass"),
+            )
+        return _default_cache
@@ -1,23 +1,35 @@
 import os
+import time
+import random
+import asyncio
+import threading
 
-from openai import OpenAI
+import openai
+from openai import OpenAI, AsyncOpenAI
+
+from robot.LLM.llms.cache import default_cache
 
 
 class LLMGPT3():
-    def __init__(self):
+    def __init__(self, cache=None):
         self.client = OpenAI(
             base_url="" , api_key="" 
         )
+        self.model = "gpt-3.5-turbo"
+        #self.model = "gpt-4o"
+        #self.model = "claude-3-5-sonnet-20240620"
+        # answers are replayed from the response cache, see LLM/llms/cache.py
+        self.cache = cache if cache is not None else default_cache()
 
     def request(self, message):  # question
-        completion = self.client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            #model="gpt-4o",
-            #model="claude-3-5-sonnet-20240620",
-            messages=message,
-        )
+        def create():
+            completion = self.client.chat.completions.create(
+                model=self.model,
+                messages=message,
+            )
+            return completion.choices[0].message.content
 
-        return completion.choices[0].message.content
+        return self.cache.call(self.model, message, {}, create)
 
     def embedding(self, question):
         embeddings = self.client.embeddings.create(
@@ -37,6 +49,169 @@ class LLMGPT3():
         return embedding_models
 
 
+
+class TokenBucket():
+    """Allow `rate` requests per second on average, in bursts of at most `burst`."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncLLMGPT3():
+    """Chat client for many concurrent requests.
+
+    At most `max_in_flight` requests are sent at once, over one pooled
+    connection, and at most `requests_per_second` are started. Rate-limit (429),
+    server (5xx), timeout and connection errors are retried with exponential
+    backoff and jitter, honouring Retry-After. Answers go through the response
+    cache first.
+
+    A client is used from one event loop: either its own background loop, through
+    `request`, `request_many` and `run`, which can be called from plain code and
+    from several threads, or the caller's, by awaiting `arequest` and
+    `arequest_many`. `close` (or `aclose` on the caller's loop) is final.
+    """
+
+    def __init__(self, base_url="", api_key="", model="gpt-3.5-turbo", max_in_flight=16,
+                 requests_per_second=None, burst=None, timeout=60.0, max_retries=5,
+                 backoff_base=1.0, backoff_max=60.0, cache=None, **request_params):
+        # retries are done here, so that they go through the concurrency and rate limits
+        self.client = AsyncOpenAI(base_url=base_url or None, api_key=api_key, timeout=timeout, max_retries=0)
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.request_params = request_params
+        self.cache = cache if cache is not None else default_cache()
+        self.stats = {"requests": 0, "retries": 0, "failures": 0}
+        self._loop = None
+        self._loop_lock = threading.Lock()
+        self._limits_loop = None
+        self._closed = False
+
+    def _check_open(self):
+        if self._closed:
+            raise RuntimeError("AsyncLLMGPT3 is closed")
+
+    def _start_loop(self):
+        with self._loop_lock:
+            self._check_open()
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, daemon=True).start()
+                self._loop = loop
+        return self._loop
+
+    def _limits(self):
+        # asyncio primitives belong to the loop they are created on, so they are
+        # created on the loop that first sends a request
+        loop = asyncio.get_running_loop()
+        if self._limits_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+            self._bucket = TokenBucket(self.requests_per_second, self.burst) if self.requests_per_second else None
+            self._limits_loop = loop
+        return self._semaphore, self._bucket
+
+    def _retry_delay(self, attempt, error):
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def _retryable(error):
+        if isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+    async def arequest(self, message, **params):
+        self._check_open()
+        params = dict(self.request_params, **params)
+        return await self.cache.acall(self.model, message, params, lambda: self._create(message, params))
+
+    async def _create(self, message, params):
+        semaphore, bucket = self._limits()
+        attempt = 0
+        while True:
+            if bucket is not None:
+                await bucket.acquire()
+            try:
+                async with semaphore:
+                    self.stats["requests"] += 1
+                    completion = await self.client.chat.completions.create(
+                        model=self.model, messages=message, **params
+                    )
+                return completion.choices[0].message.content
+            except Exception as error:
+                if not self._retryable(error) or attempt >= self.max_retries:
+                    self.stats["failures"] += 1
+                    raise
+                self.stats["retries"] += 1
+                await asyncio.sleep(self._retry_delay(attempt, error))
+                attempt += 1
+
+    async def arequest_many(self, messages, return_exceptions=False, **params):
+        return await asyncio.gather(
+            *[self.arequest(message, **params) for message in messages], return_exceptions=return_exceptions
+        )
+
+    def request(self, message, **params):
+        loop = self._start_loop()
+        return asyncio.run_coroutine_threadsafe(self.arequest(message, **params), loop).result()
+
+    def request_many(self, messages, return_exceptions=False, **params):
+        """Send all `messages` concurrently within the limits, answers come back in order."""
+        loop = self._start_loop()
+        return asyncio.run_coroutine_threadsafe(
+            self.arequest_many(messages, return_exceptions, **params), loop
+        ).result()
+
+    def run(self, coroutine):
+        """Run a coroutine using this client on its background loop and wait for its result."""
+        loop = self._start_loop()
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def close(self):
+        """Close the connections and stop the background loop, the client can not be used afterwards."""
+        with self._loop_lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._loop is not None:
+                asyncio.run_coroutine_threadsafe(self.client.close(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+
+    async def aclose(self):
+        """`close` for a client used on the caller's event loop."""
+        if not self._closed:
+            self._closed = True
+            await self.client.close()
+
+
 if __name__ == '__main__':
     llm = LLMGPT3()
     embedding_models = llm.list_embedding_models()
@@ -0,0 +1,111 @@
+"""A local stand-in for the OpenAI chat completions endpoint.
+
+Answers every chat request after a configurable latency, and fails a share of
+them with 429 or 500, so that clients can be exercised without an API key:
+
+    python stub_server.py --port 8000 --latency 0.2 --error_rate 0.1
+    llm = AsyncLLMGPT3(base_url="http://127.0.0.1:8000/v1", api_key="stub")
+
+By default the answer echoes the last user message; --answer sets a fixed one.
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        server = self.server
+        with server.lock:
+            server.stats["requests"] += 1
+            server.stats["in_flight"] += 1
+            server.stats["max_in_flight"] = max(server.stats["max_in_flight"], server.stats["in_flight"])
+        try:
+            time.sleep(server.latency)
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+                return
+            if random.random() < server.error_rate:
+                if random.random() < 0.5:
+                    self._send_json(429, {"error": {"message": "rate limited"}}, {"Retry-After": "0"})
+                else:
+                    self._send_json(500, {"error": {"message": "server error"}})
+                return
+            messages = request.get("messages", [])
+            answer = server.answer if server.answer is not None else (messages[-1]["content"] if messages else "")
+            self._send_json(200, {
+                "id": f"stub-{server.stats['requests']}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+        finally:
+            with server.lock:
+                server.stats["in_flight"] -= 1
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            with self.server.lock:
+                self._send_json(200, dict(self.server.stats))
+        else:
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host="127.0.0.1", port=8000, latency=0.0, error_rate=0.0, answer=None):
+    """Create the stub server; port 0 picks a free port (see server.server_address)."""
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.error_rate = error_rate
+    server.answer = answer
+    server.lock = threading.Lock()
+    server.stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+    return server
+
+
+def start_in_thread(**kwargs):
+    """Start a stub server in a background thread. Returns (server, base_url)."""
+    server = make_server(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, f"http://{host}:{port}/v1"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before each answer")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="share of requests failed with 429 or 500")
+    parser.add_argument("--answer", type=str, default=None, help="fixed answer, the last message is echoed if not set")
+    args = parser.parse_args()
+
+    server = make_server(args.host, args.port, args.latency, args.error_rate, args.answer)
+    print(f"Stub chat completions server on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
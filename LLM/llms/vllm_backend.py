@@ -0,0 +1,108 @@
+"""Batched generation with a local vLLM model.
+
+The evaluation loops are written as generators that yield the prompt of each
+round and receive the model's answer (see section_rounds in
+intsr2goal_test_main_s.py). `run_batched` drives many of them in lockstep: at
+every step the prompts of all active generators, first rounds and feedback
+rounds alike, go to the engine in one `generate` call, so that vLLM batches
+them, and the prompts sharing the few-shot system prompt reuse its KV cache
+through prefix caching.
+
+`MockLLM` stands in for `vllm.LLM` on machines without a GPU:
+
+    backend = VLLMBackend(engine=MockLLM(answer="On_Chips_Table3"))
+"""
+import time
+from types import SimpleNamespace
+
+
+class VLLMBackend():
+
+    def __init__(self, model=None, download_dir=None, max_new_tokens=100, temperature=0.8, top_p=0.95,
+                 enable_prefix_caching=True, engine=None, **engine_kwargs):
+        if engine is None:
+            from vllm import LLM
+            engine = LLM(model=model, download_dir=download_dir, enable_prefix_caching=enable_prefix_caching,
+                         **engine_kwargs)
+        self.engine = engine
+        try:
+            from vllm import SamplingParams
+        except ImportError:
+            # a stand-in engine only reads the attributes
+            SamplingParams = SimpleNamespace
+        self.sampling_params = SamplingParams(temperature=temperature, top_p=top_p, max_tokens=max_new_tokens)
+        self.stats = {"calls": 0, "prompts": 0, "max_batch": 0, "seconds": 0.0}
+
+    def generate(self, prompts):
+        """Texts generated for `prompts`, in one engine call."""
+        if not prompts:
+            return []
+        start = time.time()
+        outputs = self.engine.generate(prompts, self.sampling_params)
+        self.stats["calls"] += 1
+        self.stats["prompts"] += len(prompts)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(prompts))
+        self.stats["seconds"] += time.time() - start
+        return [output.outputs[0].text for output in outputs]
+
+
+def run_batched(generate, jobs, on_done, max_batch=256):
+    """Drive generators in lockstep, batching their prompts.
+
+    `jobs` is an iterable of (key, generator); each generator yields prompts, is
+    sent the text generated for them by `generate(list of prompts)` and returns its
+    result, which is passed to `on_done(key, result)`. At most `max_batch`
+    generators are active at once, new ones start as soon as others finish.
+    """
+    jobs = iter(jobs)
+    active = []  # [key, generator, pending prompt]
+
+    def start(key, rounds):
+        try:
+            active.append([key, rounds, next(rounds)])
+        except StopIteration as stop:
+            on_done(key, stop.value)
+
+    while True:
+        for key, rounds in jobs:
+            start(key, rounds)
+            if len(active) >= max_batch:
+                break
+        if not active:
+            return
+        texts = generate([prompt for _, _, prompt in active])
+        still_active = []
+        for job, text in zip(active, texts):
+            key, rounds, _ = job
+            try:
+                job[2] = rounds.send(text)
+                still_active.append(job)
+            except StopIteration as stop:
+                on_done(key, stop.value)
+        active = still_active
+
+
+class MockLLM():
+    """CPU stand-in for `vllm.LLM.generate`.
+
+    Each call takes `call_latency` seconds plus `prompt_latency` per prompt, which
+    models a GPU step whose cost barely grows with the batch. `answer` is a string,
+    or a function of the prompt, and defaults to echoing the prompt's last line.
+    """
+
+    def __init__(self, answer=None, call_latency=0.05, prompt_latency=0.0005):
+        self.answer = answer
+        self.call_latency = call_latency
+        self.prompt_latency = prompt_latency
+
+    def _answer(self, prompt):
+        if self.answer is None:
+            return prompt.rstrip().splitlines()[-1] if prompt.strip() else ""
+        return self.answer(prompt) if callable(self.answer) else self.answer
+
+    def generate(self, prompts, sampling_params=None):
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        time.sleep(self.call_latency + self.prompt_latency * len(prompts))
+        return [SimpleNamespace(prompt=prompt, outputs=[SimpleNamespace(text=self._answer(prompt))])
+                for prompt in prompts]
@@ -0,0 +1,101 @@
+"""Prompt assembly for the planner evaluations.
+
+A planner prompt is the system prompt of a (difficulty, shots) setting, the
+optional background of retrieved or trimmed contexts, the task prompt and the
+instruction:
+
+    prefix + "\\n" + [background + "\\n"] + prompt2 + "\\n" + question + suffix
+
+The system prompt is built once per setting and returned as the explicit
+`prefix` of every prompt, the part that vLLM prefix caching and API prompt
+caches can reuse since it comes first. Token counts are kept per part, so the
+cost of the backgrounds shows in `report()`.
+"""
+import re
+from collections import namedtuple
+from functools import lru_cache
+
+Prompt = namedtuple("Prompt", ["prefix", "text", "tokens"])
+
+
+def _load_encoder(tokenizer):
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(tokenizer).encode
+        except KeyError:
+            return tiktoken.get_encoding(tokenizer).encode
+    except Exception:
+        # not installed, unknown name or no access to the encoding files
+        pass
+    try:
+        from transformers import AutoTokenizer
+        # only a local path or a model already in the Hugging Face cache, counting
+        # tokens must not download files or run the model's code
+        hf_tokenizer = AutoTokenizer.from_pretrained(tokenizer, local_files_only=True)
+        return lambda text: hf_tokenizer.encode(text, add_special_tokens=False)
+    except Exception:
+        return None
+
+
+def token_counter(tokenizer=None):
+    """A function counting the tokens of a text.
+
+    `tokenizer` is an OpenAI model or encoding name (counted with tiktoken), or the
+    path or cached name of a Hugging Face model (counted with its transformers
+    tokenizer). Without one, or when neither library can load it offline, words and
+    punctuation marks are counted, a rough approximation.
+    """
+    encode = _load_encoder(tokenizer) if tokenizer is not None else None
+    if encode is None:
+        encode = re.compile(r"\w+|[^\w\s]").findall
+
+    @lru_cache(maxsize=4096)
+    def count(text):
+        return len(encode(text))
+
+    return count
+
+
+class PromptBuilder():
+
+    def __init__(self, system_prompt=None, prompt2="", suffix="", count_tokens=None):
+        # system_prompt(num_examples, difficulty), e.g. generate_prompt1
+        self.system_prompt = system_prompt
+        self.prompt2 = prompt2
+        self.suffix = suffix
+        self.count_tokens = count_tokens or token_counter()
+        self._prefixes = {}
+        self.totals = {"requests": 0, "prefix": 0, "background": 0, "question": 0}
+
+    def prefix(self, num_examples, difficulty):
+        """The system prompt of a setting, built on first use."""
+        key = (num_examples, difficulty)
+        if key not in self._prefixes:
+            self._prefixes[key] = self.system_prompt(num_examples, difficulty)
+        return self._prefixes[key]
+
+    def build(self, prefix, question, background=None):
+        """The prompt of an instruction under a system prompt `prefix`, with an optional background."""
+        head = prefix + "\n"
+        middle = background + "\n" if background is not None else ""
+        tail = self.prompt2 + "\n" + question + self.suffix
+        tokens = {"prefix": self.count_tokens(head), "background": self.count_tokens(middle) if middle else 0,
+                  "question": self.count_tokens(tail)}
+        tokens["total"] = tokens["prefix"] + tokens["background"] + tokens["question"]
+        return Prompt(head, head + middle + tail, tokens)
+
+    def record(self, prompt):
+        """Count one request sent with `prompt`."""
+        self.totals["requests"] += 1
+        for part in ("prefix", "background", "question"):
+            self.totals[part] += prompt.tokens[part]
+
+    def report(self):
+        """Mean prompt tokens per request, in total and per part."""
+        requests = self.totals["requests"]
+        if not requests:
+            return {"requests": 0}
+        means = {part: self.totals[part] / requests for part in ("prefix", "background", "question")}
+        means["total"] = sum(means.values())
+        return {"requests": requests, **{f"mean_{part}_tokens": round(value, 1) for part, value in means.items()}}
@@ -0,0 +1,128 @@
+"""Append-only CSV/JSONL output of evaluation records, with checkpoints.
+
+A ResultSink keeps its files open and buffered, writes each record as soon as it
+is complete, and every `flush_every` records or `flush_interval` seconds flushes
+and fsyncs them, then appends a checkpoint line to `<csv>.ckpt`:
+
+    {"ids": [3, 7, 1], "csv_bytes": 18234, "jsonl_bytes": 20311}
+
+A checkpoint is only written once the records it lists are on disk. When a run is
+resumed, the files are cut back to the sizes of the last checkpoint, dropping
+any record written after it, and the checkpointed ids are reported as done.
+
+The first checkpoint line records the `fingerprint` of the run's settings. A
+checkpoint with another fingerprint is not resumed: its files are started over.
+"""
+import os
+import csv
+import json
+import time
+
+CHECKPOINT_SUFFIX = ".ckpt"
+
+
+def read_checkpoint(path):
+    """(done ids, csv bytes, jsonl bytes, fingerprint) of a checkpoint file, a torn last
+    line is ignored."""
+    done, csv_bytes, jsonl_bytes, fingerprint = [], 0, 0, None
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as fin:
+            for n, line in enumerate(fin):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if n == 0:
+                    fingerprint = entry.get("fingerprint")
+                done.extend(entry["ids"])
+                csv_bytes, jsonl_bytes = entry["csv_bytes"], entry["jsonl_bytes"]
+    return done, csv_bytes, jsonl_bytes, fingerprint
+
+
+class ResultSink():
+
+    def __init__(self, csv_path, headers, jsonl_path=None, resume=False, fingerprint=None, flush_every=20,
+                 flush_interval=5.0):
+        self.csv_path = csv_path
+        self.jsonl_path = jsonl_path
+        self.checkpoint_path = csv_path + CHECKPOINT_SUFFIX
+        self.headers = headers
+        self.fingerprint = fingerprint
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.done = []
+        self.pending = []
+        self.flushed_at = time.time()
+        if resume and os.path.exists(self.checkpoint_path):
+            self.done, csv_bytes, jsonl_bytes, fingerprint = read_checkpoint(self.checkpoint_path)
+            if fingerprint != self.fingerprint:
+                print(f"Not resuming {csv_path}: it was written with other settings, starting over")
+                resume = False
+                self.done = []
+        if resume and os.path.exists(self.checkpoint_path):
+            self._truncate(csv_path, csv_bytes)
+            if jsonl_path is not None:
+                self._truncate(jsonl_path, jsonl_bytes)
+            self._truncate(self.checkpoint_path, self._checkpoint_size())
+            mode = "a"
+        else:
+            mode = "w"
+        self.csv_file = open(csv_path, mode, newline="", encoding="utf-8")
+        self.writer = csv.writer(self.csv_file)
+        self.jsonl_file = open(jsonl_path, mode, encoding="utf-8") if jsonl_path is not None else None
+        self.checkpoint_file = open(self.checkpoint_path, mode, encoding="utf-8")
+        if mode == "w":
+            self.writer.writerow(headers)
+            self.flush()
+
+    @staticmethod
+    def _truncate(path, size):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _checkpoint_size(self):
+        # the bytes of the complete checkpoint lines
+        size = 0
+        with open(self.checkpoint_path, "rb") as fin:
+            for line in fin:
+                if not line.endswith(b"\n"):
+                    break
+                size += len(line)
+        return size
+
+    def write(self, id, record):
+        """Append one record, a row in the order of the headers."""
+        self.writer.writerow(record)
+        if self.jsonl_file is not None:
+            self.jsonl_file.write(json.dumps(dict(zip(self.headers, record)), ensure_ascii=False) + "\n")
+        self.pending.append(id)
+        if len(self.pending) >= self.flush_every or time.time() - self.flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Make the written records durable, then checkpoint them."""
+        files = [self.csv_file] + ([self.jsonl_file] if self.jsonl_file is not None else [])
+        for f in files:
+            f.flush()
+            os.fsync(f.fileno())
+        if self.pending or self.checkpoint_file.tell() == 0:
+            entry = {"ids": self.pending,
+                     "csv_bytes": os.fstat(self.csv_file.fileno()).st_size,
+                     "jsonl_bytes": os.fstat(self.jsonl_file.fileno()).st_size if self.jsonl_file is not None else 0}
+            if self.checkpoint_file.tell() == 0:
+                entry["fingerprint"] = self.fingerprint
+            self.checkpoint_file.write(json.dumps(entry) + "\n")
+            self.checkpoint_file.flush()
+            os.fsync(self.checkpoint_file.fileno())
+            self.done.extend(self.pending)
+        self.pending = []
+        self.flushed_at = time.time()
+
+    def close(self):
+        if self.csv_file.closed:
+            return
+        self.flush()
+        for f in (self.csv_file, self.jsonl_file, self.checkpoint_file):
+            if f is not None:
+                f.close()
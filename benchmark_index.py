@@ -0,0 +1,164 @@
+import os
+import argparse
+import csv
+import json
+import gc
+import tempfile
+import time
+
+import faiss
+import numpy as np
+
+from retrieval_lm.src.index import Indexer
+from retrieval_lm.src.embedding_shards import index_shards, list_shards, load_shard, superseded_ids
+
+
+def load_queries(args, corpus_paths):
+    """Query vectors from a .npy file or a shard glob, or sampled from the corpus."""
+    if args.queries:
+        if args.queries.endswith(".npy"):
+            return np.load(args.queries).astype(np.float32)
+        queries = [np.asarray(load_shard(path)[1], dtype=np.float32) for path in list_shards(args.queries)]
+        return np.concatenate(queries)[: args.n_queries]
+    # perturbed corpus vectors stand in for real questions
+    embeddings = np.concatenate([np.asarray(load_shard(path)[1], dtype=np.float32) for path in corpus_paths])
+    rng = np.random.default_rng(args.seed)
+    queries = embeddings[rng.choice(len(embeddings), min(args.n_queries, len(embeddings)), replace=False)]
+    noise = rng.normal(scale=queries.std() * 0.1, size=queries.shape)
+    return (queries + noise).astype(np.float32)
+
+
+def rss_mb():
+    """Current resident set size of the process, None where it cannot be read."""
+    try:
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        pass
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process().memory_info().rss / 2 ** 20
+
+
+def index_size_mb(index):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "index.faiss")
+        faiss.write_index(index.index, path)
+        return os.path.getsize(path) / 2 ** 20
+
+
+def recall_at_k(ids, ground_truth, k):
+    hits = [len(set(ids[i, :k]) & set(ground_truth[i, :k])) for i in range(len(ids))]
+    return float(np.mean(hits)) / k
+
+
+def measure_latency(index, queries, k, batch_size, repeats):
+    """Per-query latency in ms for each batch, over `repeats` passes of the query set."""
+    latencies = []
+    for _ in range(repeats):
+        for start in range(0, len(queries), batch_size):
+            batch = queries[start:start + batch_size]
+            start_time = time.perf_counter()
+            index.index.search(batch, k)
+            latencies.append((time.perf_counter() - start_time) * 1000 / len(batch))
+    return np.array(latencies)
+
+
+def benchmark(args):
+    corpus_paths = list_shards(args.passages_embeddings)
+    # rows replaced or removed by incremental updates are left out, as when building the retrieval index
+    exclude = superseded_ids(os.path.dirname(corpus_paths[0]))
+    queries = load_queries(args, corpus_paths)
+    dim = queries.shape[1]
+    print(f"Benchmarking {len(queries)} queries against {len(corpus_paths)} shards")
+
+    ground_truth = None
+    report = []
+    # the exact inner-product index is the reference for recall
+    index_factories = ["Flat"] + [f for f in args.index_factories if f != "Flat"]
+    for index_factory in index_factories:
+        # the previous index is freed first, so that the growth is this index's own
+        gc.collect()
+        rss_before = rss_mb()
+        start_time = time.time()
+        index = Indexer(dim, index_factory=index_factory, train_sample_size=args.train_sample_size)
+        index_shards(index, corpus_paths, args.indexing_batch_size, exclude=exclude)
+        index.train_pending()
+        build_time = time.time() - start_time
+        rss_after = rss_mb()
+        rss_growth = round(rss_after - rss_before, 2) if rss_before is not None else None
+
+        search_params = [{}]
+        if "HNSW" in index_factory:
+            search_params = [{"ef_search": ef} for ef in args.ef_search]
+        elif "IVF" in index_factory:
+            search_params = [{"nprobe": nprobe} for nprobe in args.nprobe]
+
+        for params in search_params:
+            index.set_search_params(**params)
+            ids, _ = index.search_knn(queries, args.k)
+            if index_factory == "Flat":
+                ground_truth = ids
+            row = {
+                "index_factory": index_factory,
+                "search_params": json.dumps(params),
+                "n_vectors": int(index.index.ntotal),
+                "build_time_s": round(build_time, 3),
+                "index_size_mb": round(index_size_mb(index), 2),
+                "rss_growth_mb": rss_growth,
+                f"recall@{args.k}": round(recall_at_k(ids, ground_truth, args.k), 4),
+            }
+            for batch_size in args.batch_sizes:
+                latencies = measure_latency(index, queries, args.k, batch_size, args.repeats)
+                for p in [50, 95, 99]:
+                    row[f"bs{batch_size}_p{p}_ms"] = round(float(np.percentile(latencies, p)), 4)
+            print(row)
+            report.append(row)
+        del index, ids
+    return report
+
+
+def write_report(report, output_path):
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    with open(output_path + ".json", "w") as fout:
+        json.dump(report, fout, indent=2)
+    fieldnames = []
+    for row in report:
+        fieldnames.extend(key for key in row if key not in fieldnames)
+    with open(output_path + ".csv", "w", newline="") as fout:
+        writer = csv.DictWriter(fout, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(report)
+    print(f"Saved report to {output_path}.json and {output_path}.csv")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--passages_embeddings", type=str, default="robot_embeddings_medium/*", help="Glob path to encoded passages")
+    parser.add_argument(
+        "--queries", type=str, default=None, help=".npy matrix or shard glob of query embeddings, sampled from the passages if not set"
+    )
+    parser.add_argument("--n_queries", type=int, default=1000, help="Number of queries to sample from the passages")
+    parser.add_argument(
+        "--index_factories",
+        type=str,
+        nargs="+",
+        default=["Flat", "HNSW32", "IVF1024,Flat", "IVF1024,PQ64", "OPQ64,IVF1024,PQ64"],
+        help="faiss index_factory strings to compare",
+    )
+    parser.add_argument("--ef_search", type=int, nargs="+", default=[16, 64, 256], help="efSearch values for HNSW indexes")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 8, 32], help="nprobe values for IVF indexes")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 16, 256], help="Query batch sizes")
+    parser.add_argument("--k", type=int, default=10, help="Number of retrieved passages")
+    parser.add_argument("--repeats", type=int, default=3, help="Passes over the query set per latency measurement")
+    parser.add_argument("--train_sample_size", type=int, default=None, help="Number of vectors used to train IVF/PQ indexes")
+    parser.add_argument("--indexing_batch_size", type=int, default=1000000, help="Batch size of the number of passages indexed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="benchmark/index_report", help="Report path without extension")
+
+    args = parser.parse_args()
+
+    write_report(benchmark(args), args.output)
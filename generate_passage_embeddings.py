@@ -7,9 +7,14 @@
 import os
 
 import argparse
+import copy
 import csv
+import json
 import logging
+import multiprocessing
 import pickle
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 import torch
@@ -21,83 +26,198 @@ import retrieval_lm.src.contriever
 import retrieval_lm.src.utils
 import retrieval_lm.src.data
 import retrieval_lm.src.normalize_text
+import retrieval_lm.src.embedding_shards
+import retrieval_lm.src.encoding
 
 
-def embed_passages(args, passages, model, tokenizer):
+def passage_text(args, p):
+    if not "text" in p:
+        text=p["ctxs"]
+    elif args.no_title or not "title" in p:
+        text = p["text"]
+    else:
+        text = p["title"] + " " + p["text"]
+    text = p["title"]
+    if args.lowercase:
+        text = text.lower()
+    if args.normalize_text:
+        text = retrieval_lm.src.normalize_text.normalize(text)
+    return text
+
+
+def embed_passages(args, passages, model, tokenizer, writer=None, chunk_size=100000):
     total = 0
     allids, allembeddings = [], []
-    batch_ids, batch_text = [], []
-    with torch.no_grad():
-        for k, p in enumerate(passages):
-            batch_ids.append(p["id"])
-            if not "text" in p:
-                text=p["ctxs"]
-            elif args.no_title or not "title" in p:
-                text = p["text"]
-            else:
-                text = p["title"] + " " + p["text"]
-            text = p["title"]
-            if args.lowercase:
-                text = text.lower()
-            if args.normalize_text:
-                text = retrieval_lm.src.normalize_text.normalize(text)
-            batch_text.append(text)
-
-            if len(batch_text) == args.per_gpu_batch_size or k == len(passages) - 1:
-
-                encoded_batch = tokenizer.batch_encode_plus(
-                    batch_text,
-                    return_tensors="pt",
-                    max_length=args.passage_maxlength,
-                    padding=True,
-                    truncation=True,
-                )
-
-                encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                embeddings = model(**encoded_batch)
-
-                embeddings = embeddings.cpu()
-                total += len(batch_ids)
-                allids.extend(batch_ids)
-                allembeddings.append(embeddings)
-
-                batch_text = []
-                batch_ids = []
-                if k % 100000 == 0 and k > 0:
-                    print(f"Encoded passages {total}")
-
-    allembeddings = torch.cat(allembeddings, dim=0).numpy()
+    max_tokens = args.max_tokens_per_batch or args.per_gpu_batch_size * args.passage_maxlength
+    for start in range(0, len(passages), chunk_size):
+        chunk = passages[start:start + chunk_size]
+        batch_ids = [p["id"] for p in chunk]
+        batch_text = [passage_text(args, p) for p in chunk]
+        embeddings = retrieval_lm.src.encoding.encode_texts(
+            batch_text, model, tokenizer, args.passage_maxlength, max_tokens, device=args.device
+        )
+        total += len(batch_ids)
+        if writer is not None:
+            # stream each chunk to disk instead of holding the shard in memory
+            writer.append(batch_ids, embeddings)
+        else:
+            allids.extend(batch_ids)
+            allembeddings.append(embeddings)
+        print(f"Encoded passages {total}")
+
+    if writer is not None:
+        return total
+    allembeddings = np.concatenate(allembeddings, axis=0)
     return allids, allembeddings
 
 
-def main(args):
+def load_model(args):
     model, tokenizer, _ = retrieval_lm.src.contriever.load_retriever(args.model_name_or_path)
     print(f"Model loaded from {args.model_name_or_path}.", flush=True)
-    model.eval()
-    model = model.cuda()
-    if not args.no_fp16:
-        model = model.half()
+    args.device = retrieval_lm.src.contriever.resolve_device(args.device)
+    model = retrieval_lm.src.contriever.prepare_retriever(
+        model, args.device, fp16=not args.no_fp16, quantize=args.quantize, num_threads=args.num_threads
+    )
+    return model, tokenizer
 
-    passages = retrieval_lm.src.data.load_passages(args.passages)
 
-    shard_size = len(passages) // args.num_shards
-    start_idx = args.shard_id * shard_size
-    end_idx = start_idx + shard_size
-    if args.shard_id == args.num_shards - 1:
-        end_idx = len(passages)
+def embed_shard(args, byte_range):
+    model, tokenizer = load_model(args)
 
-    passages = passages[start_idx:end_idx]
-    print(f"Embedding generation for {len(passages)} passages from idx {start_idx} to {end_idx}.")
-
-    allids, allembeddings = embed_passages(args, passages, model, tokenizer)
+    # read only this shard's lines instead of the whole passages file
+    start_idx, end_idx = byte_range
+    passages = retrieval_lm.src.data.load_passages_range(args.passages, start_idx, end_idx)
+    print(f"Embedding generation for {len(passages)} passages from byte {start_idx} to {end_idx}.")
 
     save_file = os.path.join(args.output_dir, args.prefix + f"_{args.shard_id:02d}")
     os.makedirs(args.output_dir, exist_ok=True)
+    shard = {"name": os.path.basename(save_file), "byte_range": [start_idx, end_idx], "device": args.device}
+
+    if args.output_format == "mmap":
+        if os.path.isdir(save_file):
+            shutil.rmtree(save_file)
+        print(f"Writing passage embeddings to {save_file}.")
+        with retrieval_lm.src.embedding_shards.ShardWriter(save_file, dtype=args.embedding_dtype) as writer:
+            total = embed_passages(args, passages, model, tokenizer, writer=writer)
+        print(f"Total passages processed {total}. Written to {save_file}.")
+        shard["count"] = total
+        return shard
+
+    allids, allembeddings = embed_passages(args, passages, model, tokenizer)
+
     print(f"Saving {len(allids)} passage embeddings to {save_file}.")
     with open(save_file, mode="wb") as f:
         pickle.dump((allids, allembeddings), f)
 
     print(f"Total passages processed {len(allids)}. Written to {save_file}.")
+    shard["count"] = len(allids)
+    return shard
+
+
+def load_all_passages(args):
+    return retrieval_lm.src.data.load_passages_range(args.passages, 0, os.path.getsize(args.passages))
+
+
+def reset_updates(args):
+    """Record the hashes of a full embedding run and drop the updates made on top of the previous one."""
+    for entry in retrieval_lm.src.embedding_shards.read_changelog(args.output_dir):
+        shard_file = os.path.join(args.output_dir, entry["shard"])
+        if os.path.isdir(shard_file):
+            shutil.rmtree(shard_file)
+    changelog_file = os.path.join(args.output_dir, retrieval_lm.src.embedding_shards.CHANGELOG_FILE)
+    if os.path.exists(changelog_file):
+        os.remove(changelog_file)
+    _, _, _, hashes = retrieval_lm.src.embedding_shards.diff_passages({}, load_all_passages(args))
+    retrieval_lm.src.embedding_shards.write_passage_hashes(args.output_dir, hashes)
+
+
+def embed_incremental(args):
+    """Embed only the passages added or modified since the last run, into a new shard."""
+    old_hashes = retrieval_lm.src.embedding_shards.read_passage_hashes(args.output_dir)
+    if old_hashes is None:
+        raise ValueError(
+            f"No {retrieval_lm.src.embedding_shards.HASHES_FILE} in {args.output_dir}, "
+            "embed the whole knowledge base once with --num_shards 1 or --num_workers first"
+        )
+    passages = load_all_passages(args)
+    added, modified, removed, hashes = retrieval_lm.src.embedding_shards.diff_passages(old_hashes, passages)
+    print(f"{len(added)} passages added, {len(modified)} modified, {len(removed)} removed.")
+    if not (added or modified or removed):
+        return
+
+    changelog = retrieval_lm.src.embedding_shards.read_changelog(args.output_dir)
+    seq = changelog[-1]["seq"] + 1 if changelog else 1
+    shard_name = args.prefix + f"_inc{seq:04d}"
+    save_file = os.path.join(args.output_dir, shard_name)
+    changed = set(added) | set(modified)
+    passages = [p for p in passages if str(p["id"]) in changed]
+
+    if os.path.isdir(save_file):
+        shutil.rmtree(save_file)
+    with retrieval_lm.src.embedding_shards.ShardWriter(save_file, dtype=args.embedding_dtype) as writer:
+        if passages:
+            model, tokenizer = load_model(args)
+            embed_passages(args, passages, model, tokenizer, writer=writer)
+
+    retrieval_lm.src.embedding_shards.append_changelog(
+        args.output_dir,
+        {"seq": seq, "shard": shard_name, "added": added, "modified": modified, "removed": removed},
+    )
+    retrieval_lm.src.embedding_shards.write_passage_hashes(args.output_dir, hashes)
+    print(f"Update {seq} written to {save_file}.")
+
+
+def main(args):
+    byte_range = retrieval_lm.src.data.passage_byte_ranges(args.passages, args.num_shards)[args.shard_id]
+    embed_shard(args, byte_range)
+    if args.num_shards == 1:
+        reset_updates(args)
+
+
+def _embed_worker(args, byte_range):
+    return embed_shard(args, byte_range)
+
+
+def launch(args):
+    """Embed the passages with `num_workers` processes, one shard each, and write a manifest."""
+    devices = args.devices
+    if not devices:
+        if torch.cuda.is_available():
+            devices = [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        else:
+            devices = ["cpu"]
+    byte_ranges = retrieval_lm.src.data.passage_byte_ranges(args.passages, args.num_workers)
+
+    worker_args = []
+    for shard_id in range(args.num_workers):
+        worker = copy.copy(args)
+        worker.shard_id = shard_id
+        worker.num_shards = args.num_workers
+        worker.device = devices[shard_id % len(devices)]
+        if worker.device == "cpu" and not worker.num_threads:
+            # split the cores between the CPU workers
+            n_cpu_workers = sum(1 for k in range(args.num_workers) if devices[k % len(devices)] == "cpu")
+            worker.num_threads = max(1, (os.cpu_count() or 1) // n_cpu_workers)
+        worker_args.append(worker)
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.num_workers, mp_context=context) as executor:
+        futures = [executor.submit(_embed_worker, worker, byte_ranges[k]) for k, worker in enumerate(worker_args)]
+        shards = [future.result() for future in futures]
+
+    manifest = {
+        "passages": args.passages,
+        "model_name_or_path": args.model_name_or_path,
+        "output_format": args.output_format,
+        "num_shards": args.num_workers,
+        "count": sum(shard["count"] for shard in shards),
+        "shards": shards,
+    }
+    reset_updates(args)
+    manifest_file = os.path.join(args.output_dir, args.prefix + "_manifest.json")
+    with open(manifest_file, "w") as fout:
+        json.dump(manifest, fout, indent=2)
+    print(f"Embedded {manifest['count']} passages in {args.num_workers} shards. Manifest written to {manifest_file}.")
 
 
 if __name__ == "__main__":
@@ -108,20 +228,55 @@ if __name__ == "__main__":
     parser.add_argument("--prefix", type=str, default="passages", help="prefix path to save embeddings")
     parser.add_argument("--shard_id", type=int, default=0, help="Id of the current shard")
     parser.add_argument("--num_shards", type=int, default=1, help="Total number of shards")
+    parser.add_argument(
+        "--num_workers", type=int, default=0, help="Embed all shards with this many worker processes and write a manifest"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only embed passages added or modified since the last run, into a new shard (mmap format)",
+    )
+    parser.add_argument(
+        "--devices", type=str, nargs="+", default=None, help="Devices assigned round-robin to the workers (default: all GPUs, else cpu)"
+    )
     parser.add_argument(
         "--per_gpu_batch_size", type=int, default=512, help="Batch size for the passage encoder forward pass"
     )
     parser.add_argument("--passage_maxlength", type=int, default=512, help="Maximum number of tokens in a passage")
+    parser.add_argument(
+        "--max_tokens_per_batch",
+        type=int,
+        default=None,
+        help="Padded token budget of a length-bucketed batch (default: per_gpu_batch_size * passage_maxlength)",
+    )
     parser.add_argument(
         "--model_name_or_path", type=str, default='../model/contriever-msmarco', help="path to directory containing model weights and config file"
     )
     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
+    parser.add_argument("--device", type=str, default="auto", help="cuda, cuda:N, cpu, or auto to pick cuda when available")
+    parser.add_argument("--quantize", action="store_true", help="apply dynamic int8 quantization to the encoder on CPU")
+    parser.add_argument("--num_threads", type=int, default=None, help="number of intra-op threads on CPU")
     parser.add_argument("--no_title", action="store_true", help="title not added to the passage body")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
     parser.add_argument("--normalize_text", action="store_true", help="lowercase text before encoding")
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        default="mmap",
+        choices=["mmap", "pickle"],
+        help="mmap writes an appendable memory-mapped shard directory, pickle the legacy single file",
+    )
+    parser.add_argument(
+        "--embedding_dtype", type=str, default="float32", choices=["float32", "float16"], help="dtype of stored embeddings"
+    )
 
     args = parser.parse_args()
 
     retrieval_lm.src.slurm.init_distributed_mode(args)
 
-    main(args)
+    if args.incremental:
+        embed_incremental(args)
+    elif args.num_workers > 0:
+        launch(args)
+    else:
+        main(args)
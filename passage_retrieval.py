@@ -10,14 +10,22 @@ import json
 import pickle
 import time
 import glob
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import numpy as np
 import torch
 from retrieval_lm.src.slurm import init_distributed_mode
 from retrieval_lm.src.normalize_text import normalize
-from retrieval_lm.src.contriever import load_retriever
+from retrieval_lm.src.contriever import load_retriever, resolve_device, prepare_retriever, cosine_drift
 from retrieval_lm.src.index import Indexer
-from retrieval_lm.src.data import load_passages
+from retrieval_lm.src.data import iter_data_chunks, resume_jsonl
+from retrieval_lm.src.passage_store import PassageStore
+from retrieval_lm.src.embedding_shards import (
+    index_manifest, index_shards, list_shards, load_saved_index, read_changelog, superseded_ids
+)
+from retrieval_lm.src.embedding_cache import QueryEmbeddingCache
+from retrieval_lm.src.encoding import encode_texts
 
 from retrieval_lm.src.evaluation import calculate_matches
 import warnings
@@ -27,66 +35,45 @@ warnings.filterwarnings('ignore')
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 
-def embed_queries(args, queries, model, tokenizer):
+def embed_queries(args, queries, model, tokenizer, cache=None):
     model.eval()
-    embeddings, batch_question = [], []
-    with torch.no_grad():
-
-        for k, q in enumerate(queries):
-            if args.lowercase:
-                q = q.lower()
-            if args.normalize_text:
-                q = normalize(q)
-            batch_question.append(q)
-
-            if len(batch_question) == args.per_gpu_batch_size or k == len(queries) - 1:
-
-                encoded_batch = tokenizer.batch_encode_plus(
-                    batch_question,
-                    return_tensors="pt",
-                    max_length=args.question_maxlength,
-                    padding=True,
-                    truncation=True,
-                )
-                encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                output = model(**encoded_batch)
-                embeddings.append(output.cpu())
-
-                batch_question = []
-
-    embeddings = torch.cat(embeddings, dim=0)
-    #print(f"Questions embeddings shape: {embeddings.size()}")
-
-    return embeddings.numpy()
-
-
-def index_encoded_data(index, embedding_files, indexing_batch_size):
-    allids = []
-    allembeddings = np.array([])
-    for i, file_path in enumerate(embedding_files):
-        #print(f"Loading file {file_path}")
-        with open(file_path, "rb") as fin:
-            ids, embeddings = pickle.load(fin)
-
-        allembeddings = np.vstack((allembeddings, embeddings)) if allembeddings.size else embeddings
-        allids.extend(ids)
-        while allembeddings.shape[0] > indexing_batch_size:
-            allembeddings, allids = add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-    while allembeddings.shape[0] > 0:
-        allembeddings, allids = add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-    #print("Data indexing completed.")
-
-
-def add_embeddings(index, embeddings, ids, indexing_batch_size):
-    end_idx = min(indexing_batch_size, embeddings.shape[0])
-    ids_toadd = ids[:end_idx]
-    embeddings_toadd = embeddings[:end_idx]
-    ids = ids[end_idx:]
-    embeddings = embeddings[end_idx:]
-    index.index_data(ids_toadd, embeddings_toadd)
-    return embeddings, ids
+    processed = []
+    for q in queries:
+        if args.lowercase:
+            q = q.lower()
+        if args.normalize_text:
+            q = normalize(q)
+        processed.append(q)
+
+    embeddings = [None] * len(processed)
+    if cache is not None:
+        for k, q in enumerate(processed):
+            embeddings[k] = cache.get(q)
+    # encode every distinct query missing from the cache once
+    missing = list(dict.fromkeys(q for q, e in zip(processed, embeddings) if e is None))
+
+    if missing:
+        encoded = encode_texts(
+            missing,
+            model,
+            tokenizer,
+            args.question_maxlength,
+            args.per_gpu_batch_size * args.question_maxlength,
+            device=args.device,
+        )
+        if cache is not None:
+            cache.put_many(missing, encoded)
+        encoded = dict(zip(missing, encoded))
+        embeddings = [encoded[q] if e is None else e for q, e in zip(processed, embeddings)]
+
+    embeddings = np.stack(embeddings)
+    #print(f"Questions embeddings shape: {embeddings.shape}")
+
+    return embeddings
+
+
+def index_encoded_data(index, embedding_files, indexing_batch_size, prefetch=True, exclude=None):
+    index_shards(index, embedding_files, indexing_batch_size, prefetch=prefetch, exclude=exclude)
 
 
 def validate(data, workers_num):
@@ -105,22 +92,18 @@ def validate(data, workers_num):
 
 def add_passages(data, passages, top_passages_and_scores):
     # add passages to original data
-    merged_data = []
-    assert len(data) == len(top_passages_and_scores)
+    top_ids, top_scores = top_passages_and_scores
+    assert len(data) == len(top_ids)
     for i, d in enumerate(data):
-        results_and_scores = top_passages_and_scores[i]
-        #print(passages[2393])
-        docs = [passages[int(doc_id)] for doc_id in results_and_scores[0]]
-        scores = [str(score) for score in results_and_scores[1]]
-        ctxs_num = len(docs)
         d["ctxs"] = [
             {
-                "id": results_and_scores[0][c],
-                "title": docs[c]["title"],
-                "text": docs[c]["text"],
-                "score": scores[c],
+                "id": str(doc_id),
+                "title": passages[doc_id]["title"],
+                "text": passages[doc_id]["text"],
+                "score": str(score),
             }
-            for c in range(ctxs_num)
+            for doc_id, score in zip(top_ids[i].tolist(), top_scores[i])
+            if doc_id >= 0
         ]
 
 
@@ -158,68 +141,205 @@ def load_data(data_path):
     return data
 
 
-def test(args):#path为query
-    # args = {"model_name_or_path":"contriever-msmarco","passages":"train_robot.jsonl"\
-    # passages_embeddings = "robot_embeddings/*"
-    # data = "n_test_robot.jsonl"
-    # output_dir = "robot_result"
-    # n_docs = 1
+def new_index(args):
+    return Indexer(
+        args.projection_size,
+        args.n_subquantizers,
+        args.n_bits,
+        mode=args.index_mode,
+        index_factory=args.index_factory,
+        ef_construction=args.ef_construction,
+        train_sample_size=args.train_sample_size,
+        id_map=args.id_map,
+    )
 
-    #print(f"Loading model from: {args.model_name_or_path}")
-    model, tokenizer, _ = load_retriever(args.model_name_or_path)
-    model.eval()
-    model = model.cuda()
-    if not args.no_fp16:
-        model = model.half()
 
-    index = Indexer(args.projection_size, args.n_subquantizers, args.n_bits)
+def load_index(args, embeddings_dir, input_paths):
+    """Load the saved index and apply the updates logged since it was saved.
+    Returns None if it does not match the embedding shards any more."""
+    index = new_index(args)
+    reason = load_saved_index(
+        index, embeddings_dir, embeddings_dir, input_paths, args.indexing_batch_size, mmap=args.mmap_index
+    )
+    if reason is not None:
+        print(f"Rebuilding the index: {reason}.")
+        return None
+    return index
+
 
+def build_index(args):
     # index all passages
-    input_paths = glob.glob(args.passages_embeddings)
-    input_paths = sorted(input_paths)
+    input_paths = list_shards(args.passages_embeddings)
     embeddings_dir = os.path.dirname(input_paths[0])
     index_path = os.path.join(embeddings_dir, "index.faiss")
+    index = None
     if args.save_or_load_index and os.path.exists(index_path):
-        index.deserialize_from(embeddings_dir)
-    else:
+        index = load_index(args, embeddings_dir, input_paths)
+    if index is None:
+        index = new_index(args)
         #print(f"Indexing passages from files {input_paths}")
         start_time_indexing = time.time()
-        index_encoded_data(index, input_paths, args.indexing_batch_size)
+        index_encoded_data(index, input_paths, args.indexing_batch_size, exclude=superseded_ids(embeddings_dir))
+        index.train_pending()
+        changelog = read_changelog(embeddings_dir)
+        index.meta["changelog_seq"] = changelog[-1]["seq"] if changelog else 0
+        index.meta["manifest"] = index_manifest(index, input_paths)
         #print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
         if args.save_or_load_index:
             index.serialize(embeddings_dir)
+    index.set_search_params(ef_search=args.ef_search, nprobe=args.nprobe)
+    return index
+
+
+class Retriever(object):
+    """Holds the encoder, the FAISS index and the passages in memory so that
+    each query only pays for tokenization, encoding and the index search."""
+
+    def __init__(self, args):
+        self.args = args
+        #print(f"Loading model from: {args.model_name_or_path}")
+        args.device = resolve_device(args.device)
+        model, tokenizer, _ = load_retriever(args.model_name_or_path)
+        self.model = prepare_retriever(
+            model, args.device, fp16=not args.no_fp16, quantize=args.quantize, num_threads=args.num_threads
+        )
+        self.tokenizer = tokenizer
+
+        self.index = build_index(args)
+
+        # passages are read from the file when they are retrieved
+        self.passages = PassageStore(args.passages)
+
+        if args.quantize and args.check_quantization > 0:
+            texts = [self.passages[i]["title"] for i in self.passages.ids[:args.check_quantization]]
+            drift = cosine_drift(model, self.model, tokenizer, texts, args.question_maxlength, args.device)
+            print(f"int8 vs fp32 cosine on {len(texts)} passages: mean {drift['mean']:.4f}, min {drift['min']:.4f}")
+
+        self.query_cache = QueryEmbeddingCache.from_args(args)
+
+        # the encoder and the index are shared between the server threads
+        self.lock = threading.Lock()
+
+    def embed_queries(self, queries):
+        return embed_queries(self.args, queries, self.model, self.tokenizer, cache=self.query_cache)
+
+    def stats(self):
+        return {"query_cache": self.query_cache.stats() if self.query_cache is not None else None}
+
+    def search_batch(self, queries, k=None):
+        if k is None:
+            k = self.args.n_docs
+        data = [{"id": i, "question": q} for i, q in enumerate(queries)]
+        with self.lock:
+            questions_embedding = self.embed_queries(queries)
+            top_ids_and_scores = self.index.search_knn(questions_embedding, k)
+        add_passages(data, self.passages, top_ids_and_scores)
+        return data
+
+    def search(self, query, k=None):
+        return self.search_batch([query], k)[0]
+
+
+def serve(retriever, host="127.0.0.1", port=8765):
+    """Answer POST /search requests with a warm retriever.
+
+    The body is {"query": str} or {"queries": [str, ...]}, with an optional "k".
+    GET /stats returns the query cache statistics.
+    """
+
+    class RetrievalHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.rstrip("/") != "/search":
+                self.send_error(404)
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                k = request.get("k")
+                if "queries" in request:
+                    result = retriever.search_batch(request["queries"], k)
+                else:
+                    result = retriever.search(request["query"], k)
+            except (KeyError, TypeError, ValueError) as e:
+                self.send_error(400, str(e))
+                return
+            body = json.dumps(result, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/stats":
+                self.send_error(404)
+                return
+            body = json.dumps(retriever.stats()).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), RetrievalHandler)
+    print(f"Serving retrieval on http://{host}:{port}/search")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
-    # load passages
-    passages = load_passages(args.passages)
-    passage_id_map = {x["id"]: x for x in passages}
 
-    data_paths = glob.glob(args.data)
-    alldata = []
-    for path in data_paths:
-        data = load_data(path)
-        #print("data:",data)
-        output_path = os.path.join(args.output_dir, os.path.basename(path))
-
-        queries = [ex["question"] for ex in data]
-        questions_embedding = embed_queries(args, queries, model, tokenizer)
+def test(args):#path为query
+    # args = {"model_name_or_path":"contriever-msmarco","passages":"train_robot.jsonl"\
+    # passages_embeddings = "robot_embeddings/*"
+    # data = "n_test_robot.jsonl"
+    # output_dir = "robot_result"
+    # n_docs = 1
 
-        # get top k results
-        start_time_retrieval = time.time()
-        top_ids_and_scores = index.search_knn(questions_embedding, args.n_docs)
-        print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
+    retriever = get_retriever(args)
 
-        add_passages(data, passage_id_map, top_ids_and_scores)
-        #hasanswer = validate(data, args.validation_workers)
-        #add_hasanswer(data, hasanswer)
+    data_paths = sorted(glob.glob(args.data))
+    output_paths = []
+    for path in data_paths:
+        output_path = os.path.join(args.output_dir, os.path.basename(path))
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        ret_list = []
-        with open(output_path, "w") as fout:
-            for ex in data:
-                json.dump(ex, fout, ensure_ascii=False)
-                ret_list.append(ex)
-                fout.write("\n")
-        return ret_list
-        #print(f"Saved results to {output_path}")init_distributed_mode
+        done = resume_jsonl(output_path) if args.resume else 0
+        if done > 0:
+            print(f"Resuming {output_path} after {done} queries.")
+
+        # queries are read, retrieved and written chunk by chunk, so memory does not grow with the file
+        encoding_time, search_time, n_queries = 0.0, 0.0, 0
+        with open(output_path, "a" if done > 0 else "w") as fout:
+            for data in iter_data_chunks(path, args.chunk_size, skip=done):
+                queries = [ex["question"] for ex in data]
+                start_time_encoding = time.time()
+                questions_embedding = retriever.embed_queries(queries)
+                encoding_time += time.time() - start_time_encoding
+
+                # get top k results
+                start_time_retrieval = time.time()
+                top_ids_and_scores = retriever.index.search_knn(questions_embedding, args.n_docs)
+                search_time += time.time() - start_time_retrieval
+
+                add_passages(data, retriever.passages, top_ids_and_scores)
+                #hasanswer = validate(data, args.validation_workers)
+                #add_hasanswer(data, hasanswer)
+                for ex in data:
+                    json.dump(ex, fout, ensure_ascii=False)
+                    fout.write("\n")
+                fout.flush()
+                n_queries += len(data)
+
+        print(f"Query encoding time on {args.device}: {encoding_time:.2f} s ({1000 * encoding_time / max(n_queries, 1):.1f} ms/query).")
+        print(f"Search time: {search_time:.1f} s.")
+        if retriever.query_cache is not None:
+            print(retriever.query_cache.report())
+        #print(f"Saved results to {output_path}")
+        output_paths.append(output_path)
+    return output_paths
 
 #将query写到test_robot.jsonl
 def get_json(query):
@@ -235,8 +355,7 @@ def get_answer():
             score = example["ctxs"][0]["score"]
             return score, answer
 
-def retri(query):
-    get_json(query)
+def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "--data",
@@ -258,6 +377,8 @@ def retri(query):
         "--validation_workers", type=int, default=32, help="Number of parallel processes to validate results"
     )
     parser.add_argument("--per_gpu_batch_size", type=int, default=64, help="Batch size for question encoding")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Number of queries retrieved and written at a time")
+    parser.add_argument("--resume", action="store_true", help="keep the results already in the output files and continue after them")
     parser.add_argument(
         "--save_or_load_index", action="store_true", help="If enabled, save index and load index if it exists"
     )
@@ -268,6 +389,12 @@ def retri(query):
         "--model_name_or_path", type=str, default='../model/contriever-msmarco',help="path to directory containing model weights and config file"
     )
     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
+    parser.add_argument("--device", type=str, default="auto", help="cuda, cuda:N, cpu, or auto to pick cuda when available")
+    parser.add_argument("--quantize", action="store_true", help="apply dynamic int8 quantization to the encoder on CPU")
+    parser.add_argument("--num_threads", type=int, default=None, help="number of intra-op threads on CPU")
+    parser.add_argument(
+        "--check_quantization", type=int, default=0, help="compare the int8 encoder with fp32 on this many passages"
+    )
     parser.add_argument("--question_maxlength", type=int, default=512, help="Maximum number of tokens in a question")
     parser.add_argument(
         "--indexing_batch_size", type=int, default=1000000, help="Batch size of the number of passages indexed"
@@ -280,18 +407,63 @@ def retri(query):
         help="Number of subquantizer used for vector quantization, if 0 flat index is used",
     )
     parser.add_argument("--n_bits", type=int, default=8, help="Number of bits per subquantizer")
+    parser.add_argument(
+        "--index_mode", type=str, default="simple", choices=["simple", "hnsw", "hclu"], help="Preset index type, ignored if --index_factory is set"
+    )
+    parser.add_argument(
+        "--index_factory", type=str, default=None, help="faiss index_factory string, e.g. Flat, HNSW32, IVF4096,Flat, OPQ64,IVF4096,PQ64"
+    )
+    parser.add_argument("--ef_construction", type=int, default=None, help="HNSW construction depth")
+    parser.add_argument("--ef_search", type=int, default=None, help="HNSW search depth, higher is slower and more accurate")
+    parser.add_argument("--nprobe", type=int, default=None, help="Number of IVF lists visited per query")
+    parser.add_argument(
+        "--train_sample_size", type=int, default=None, help="Number of vectors used to train IVF/PQ indexes (default: 64 per centroid)"
+    )
+    parser.add_argument(
+        "--mmap_index",
+        action="store_true",
+        help="memory-map the index saved with --save_or_load_index instead of reading it",
+    )
+    parser.add_argument(
+        "--id_map",
+        action="store_true",
+        help="store passage ids in the index so that updates from generate_passage_embeddings.py --incremental can replace passages",
+    )
     parser.add_argument("--lang", nargs="+")
     parser.add_argument("--dataset", type=str, default="none")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
     parser.add_argument("--normalize_text", action="store_true", help="normalize text")
+    parser.add_argument(
+        "--query_cache_size", type=int, default=10000, help="Number of query embeddings kept in memory, 0 disables the cache"
+    )
+    parser.add_argument("--query_cache_path", type=str, default=None, help="sqlite file persisting the query embedding cache")
+
+    parser.add_argument("--serve", action="store_true", help="keep the retriever warm and answer queries over HTTP")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host of the retrieval server")
+    parser.add_argument("--port", type=int, default=8765, help="port of the retrieval server")
+    parser.add_argument(
+        "--query", type=str, default=None,
+        help="only search this query (e.g. 请你来一下吧台。) and print its hits, instead of the questions of --data",
+    )
+    return parser
+
+
+_retriever = None
 
-    args = parser.parse_args()
-    init_distributed_mode(args)
-    #print(args)
-    ret = test(args)
-    #print(ret)
 
-    return  ret[0]
+def get_retriever(args=None):
+    """Build the process-wide retriever on first use and reuse it afterwards."""
+    global _retriever
+    if _retriever is None:
+        if args is None:
+            args, _ = get_parser().parse_known_args()
+            init_distributed_mode(args)
+        _retriever = Retriever(args)
+    return _retriever
+
+
+def retri(query):
+    return get_retriever().search(query)
 
     # example = ret[0]
     # answer = example["ctxs"][0]["text"]
@@ -299,16 +471,21 @@ def retri(query):
     # return score, answer
 
 if __name__ == "__main__":
-    # query = "请你拿一下软饮料到第三张桌子位置。"
-    # score,answer = retri(query)
-    # print(score,answer)
-
-    query = "请你来一下吧台。"
-    all_ret = retri(query)
-    for i,example in enumerate(all_ret["ctxs"]):
-        answer = example["text"]
-        score = example["score"]
-        id = example["id"]
-        print(i,answer,score,"  id=",id)
-
-
+    args = get_parser().parse_args()
+    init_distributed_mode(args)
+    if args.serve:
+        serve(get_retriever(args), args.host, args.port)
+    elif args.query is not None:
+        # query = "请你拿一下软饮料到第三张桌子位置。"
+        # score,answer = retri(query)
+        # print(score,answer)
+
+        all_ret = get_retriever(args).search(args.query)
+        for i,example in enumerate(all_ret["ctxs"]):
+            answer = example["text"]
+            score = example["score"]
+            id = example["id"]
+            print(i,answer,score,"  id=",id)
+    else:
+        # retrieve for every question of --data, e.g. robot_retr_result/medium_instr_goal.jsonl
+        test(args)
@@ -136,3 +136,44 @@ def load_retriever(model_path, pooling="average", random_init=False):
         retriever = utils.load_hf(model_class, model_path)
 
     return retriever, tokenizer, retriever_model_id
+
+
+def resolve_device(device="auto"):
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def prepare_retriever(model, device="cuda", fp16=True, quantize=False, num_threads=None):
+    """Put the encoder in inference mode on `device`.
+
+    On GPU the model is moved there and optionally cast to fp16. On CPU, fp16 is
+    skipped, `num_threads` sets the intra-op threads and `quantize` applies
+    dynamic int8 quantization to the linear layers. The input model is left
+    untouched when quantized, so it can serve as the fp32 reference.
+    """
+    model.eval()
+    if device.startswith("cuda"):
+        model = model.to(device)
+        if fp16:
+            model = model.half()
+        return model
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    model = model.to(device)
+    if quantize:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+
+def cosine_drift(reference, model, tokenizer, texts, maxlength=512, device="cpu"):
+    """Cosine similarity between the embeddings of `reference` (fp32) and `model` on `texts`."""
+    encoded = tokenizer.batch_encode_plus(
+        texts, return_tensors="pt", max_length=maxlength, padding=True, truncation=True
+    )
+    encoded = {k: v.to(device) for k, v in encoded.items()}
+    with torch.inference_mode():
+        expected = reference(**encoded).float()
+        actual = model(**encoded).float()
+    cosine = torch.nn.functional.cosine_similarity(expected, actual, dim=-1)
+    return {"mean": cosine.mean().item(), "min": cosine.min().item()}
@@ -242,3 +242,82 @@ def load_passages(path):
                     ex = {"id": row[0], "title": row[2], "text": row[1]}
                     passages.append(ex)
     return passages
+
+
+def passage_byte_ranges(path, num_ranges):
+    """Split a passages file into `num_ranges` contiguous byte ranges aligned on line starts."""
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as fin:
+        for k in range(1, num_ranges):
+            position = max(size * k // num_ranges, bounds[-1])
+            if position > 0:
+                fin.seek(position - 1)
+                fin.readline()
+                position = fin.tell()
+            bounds.append(min(position, size))
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def load_passages_range(path, start, end):
+    """Load only the passages whose lines start inside [start, end)."""
+    passages = []
+    with open(path, "rb") as fin:
+        fin.seek(start)
+        while fin.tell() < end:
+            line = fin.readline()
+            if not line:
+                break
+            line = line.decode("utf-8")
+            if not line.strip():
+                continue
+            if path.endswith(".jsonl"):
+                passages.append(json.loads(line))
+            else:
+                row = next(csv.reader([line], delimiter="\t"))
+                if not row[0] == "id":
+                    passages.append({"id": row[0], "title": row[2], "text": row[1]})
+    return passages
+
+
+def iter_data_chunks(path, chunk_size, skip=0):
+    """Yield lists of at most `chunk_size` examples of a .jsonl file, read lazily,
+    after skipping the first `skip` ones. A .json list is loaded then chunked."""
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as fin:
+            data = json.load(fin)
+        for start in range(skip, len(data), chunk_size):
+            yield data[start:start + chunk_size]
+        return
+    chunk = []
+    seen = 0
+    with open(path, "r", encoding="utf-8") as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+            seen += 1
+            if seen <= skip:
+                continue
+            chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def resume_jsonl(path):
+    """Number of complete lines in an output .jsonl file, dropping a partially written last line."""
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb+") as fout:
+        content_end = 0
+        count = 0
+        for line in fout:
+            if not line.endswith(b"\n"):
+                break
+            content_end += len(line)
+            count += 1
+        fout.truncate(content_end)
+    return count
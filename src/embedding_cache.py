@@ -0,0 +1,109 @@
+# Cache of query embeddings, so that repeated instructions skip the encoder.
+
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class QueryEmbeddingCache(object):
+    """LRU cache of query embeddings, optionally backed by a sqlite file.
+
+    Entries are keyed on everything that changes the embedding of a query: the
+    model, the lowercase/normalize flags, the maximum length, the device and
+    precision of the encoder (fp16, int8 quantization) and the text.
+    """
+
+    def __init__(self, model_id, lowercase=False, normalize_text=False, maxlength=512, device="cpu", fp16=False,
+                 quantize=False, capacity=10000, path=None):
+        self.prefix = json.dumps([model_id, lowercase, normalize_text, maxlength, str(device), fp16, quantize])
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dtype TEXT, data BLOB)"
+            )
+            self.db.commit()
+
+    @classmethod
+    def from_args(cls, args):
+        if args.query_cache_size <= 0:
+            return None
+        return cls(
+            args.model_name_or_path,
+            lowercase=args.lowercase,
+            normalize_text=args.normalize_text,
+            maxlength=args.question_maxlength,
+            device=args.device,
+            fp16=not args.no_fp16,
+            quantize=args.quantize,
+            capacity=args.query_cache_size,
+            path=args.query_cache_path,
+        )
+
+    def key(self, query):
+        return hashlib.sha1((self.prefix + "\n" + query).encode("utf-8")).hexdigest()
+
+    def get(self, query):
+        key = self.key(query)
+        with self.lock:
+            embedding = self.entries.get(key)
+            if embedding is not None:
+                self.entries.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute("SELECT dtype, data FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    embedding = np.frombuffer(row[1], dtype=row[0])
+                    self._remember(key, embedding)
+            if embedding is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return embedding
+
+    def put_many(self, queries, embeddings):
+        with self.lock:
+            rows = []
+            for query, embedding in zip(queries, embeddings):
+                key = self.key(query)
+                embedding = np.array(embedding)
+                self._remember(key, embedding)
+                rows.append((key, embedding.dtype.name, embedding.tobytes()))
+            if self.db is not None and rows:
+                self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+                self.db.commit()
+
+    def _remember(self, key, embedding):
+        self.entries[key] = embedding
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        stats = {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate, "size": len(self)}
+        if self.db is not None:
+            stats["disk_size"] = self.db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        message = f"Query cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%}), {stats['size']} entries in memory"
+        if "disk_size" in stats:
+            message += f", {stats['disk_size']} on disk"
+        return message
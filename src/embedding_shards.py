@@ -0,0 +1,425 @@
+# Memory-mapped storage for passage embedding shards.
+#
+# A shard is a directory holding
+#   header.json     {"format", "version", "dim", "dtype", "count"}
+#   embeddings.bin  raw row-major matrix of `count` x `dim` values of `dtype`
+#   ids.bin         raw int64 passage ids, one per row
+# Rows are appended at the end of both binary files and the header is rewritten
+# afterwards, so a shard can grow without rewriting what is already on disk and
+# an interrupted append is ignored on the next open. Shards written by older
+# versions of generate_passage_embeddings.py as a single pickle are still read.
+#
+# Incremental updates of the knowledge base are tracked next to the shards:
+#   passage_hashes.json  content hash of every embedded passage, by id
+#   changelog.jsonl      one entry per update: the new shard holding the added and
+#                        modified passages, and the ids that were modified or removed
+#
+# A saved index records a manifest of the shards it was built from (see
+# index_manifest), and is rebuilt when they no longer match.
+
+import os
+import glob
+import json
+import time
+import hashlib
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SHARD_FORMAT = "dqma-embeddings"
+SHARD_VERSION = 1
+HEADER_FILE = "header.json"
+EMBEDDINGS_FILE = "embeddings.bin"
+IDS_FILE = "ids.bin"
+HASHES_FILE = "passage_hashes.json"
+CHANGELOG_FILE = "changelog.jsonl"
+# files kept next to the shards that a shard glob should skip
+NON_SHARD_SUFFIXES = (".json", ".jsonl", ".faiss", ".npy")
+
+
+def is_mmap_shard(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, HEADER_FILE))
+
+
+def list_shards(pattern):
+    """Sorted shard paths matching `pattern`, without manifests, indexes and other metadata."""
+    return sorted(path for path in glob.glob(pattern) if is_mmap_shard(path) or (
+        os.path.isfile(path) and not path.endswith(NON_SHARD_SUFFIXES)
+    ))
+
+
+def read_header(path):
+    with open(os.path.join(path, HEADER_FILE), "r") as fin:
+        header = json.load(fin)
+    if header.get("format") != SHARD_FORMAT:
+        raise ValueError(f"{path} is not an embedding shard")
+    return header
+
+
+def _write_header(path, header):
+    tmp_file = os.path.join(path, HEADER_FILE + ".tmp")
+    with open(tmp_file, "w") as fout:
+        json.dump(header, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.replace(tmp_file, os.path.join(path, HEADER_FILE))
+
+
+class ShardWriter(object):
+    """Create a shard, or reopen an existing one, and append rows to it."""
+
+    def __init__(self, path, dim=None, dtype="float32"):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, HEADER_FILE)):
+            self.header = read_header(path)
+            if dim is not None and dim != self.header["dim"]:
+                raise ValueError(f"Shard {path} has dimension {self.header['dim']}, got {dim}")
+        else:
+            self.header = {
+                "format": SHARD_FORMAT,
+                "version": SHARD_VERSION,
+                "dim": dim,
+                "dtype": np.dtype(dtype).name,
+                "count": 0,
+            }
+        self.dtype = np.dtype(self.header["dtype"])
+        self._embeddings_file = open(os.path.join(path, EMBEDDINGS_FILE), "ab")
+        self._ids_file = open(os.path.join(path, IDS_FILE), "ab")
+        # drop rows of an append that was interrupted before its header was written
+        if self.header["dim"] is not None:
+            self._embeddings_file.truncate(self.header["count"] * self.header["dim"] * self.dtype.itemsize)
+        self._ids_file.truncate(self.header["count"] * np.dtype(np.int64).itemsize)
+        if self.header["count"] == 0:
+            _write_header(path, self.header)
+
+    def __len__(self):
+        return self.header["count"]
+
+    def append(self, ids, embeddings):
+        embeddings = np.ascontiguousarray(embeddings, dtype=self.dtype)
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        if embeddings.ndim != 2 or embeddings.shape[0] != ids.shape[0]:
+            raise ValueError("Expected one id per embedding row")
+        if self.header["dim"] is None:
+            self.header["dim"] = embeddings.shape[1]
+        elif embeddings.shape[1] != self.header["dim"]:
+            raise ValueError(f"Shard {self.path} has dimension {self.header['dim']}, got {embeddings.shape[1]}")
+        self._embeddings_file.write(embeddings.tobytes())
+        self._ids_file.write(ids.tobytes())
+        # the rows must be on disk before the header counts them
+        for f in (self._embeddings_file, self._ids_file):
+            f.flush()
+            os.fsync(f.fileno())
+        self.header["count"] += ids.shape[0]
+        _write_header(self.path, self.header)
+
+    def close(self):
+        self._embeddings_file.close()
+        self._ids_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_shard(path, ids, embeddings, dtype="float32"):
+    with ShardWriter(path, embeddings.shape[1], dtype) as writer:
+        writer.append(ids, embeddings)
+
+
+def open_shard(path):
+    """Map a shard into memory without reading it. Returns (ids, embeddings)."""
+    header = read_header(path)
+    count, dim = header["count"], header["dim"]
+    if count == 0:
+        return np.empty((0,), dtype=np.int64), np.empty((0, dim or 0), dtype=header["dtype"])
+    ids = np.memmap(os.path.join(path, IDS_FILE), dtype=np.int64, mode="r", shape=(count,))
+    embeddings = np.memmap(
+        os.path.join(path, EMBEDDINGS_FILE), dtype=header["dtype"], mode="r", shape=(count, dim)
+    )
+    return ids, embeddings
+
+
+def load_shard(path):
+    """Read a shard in either the memory-mapped or the legacy pickle format."""
+    if is_mmap_shard(path):
+        return open_shard(path)
+    with open(path, "rb") as fin:
+        ids, embeddings = pickle.load(fin)
+    return ids, embeddings
+
+
+def iter_shard_batches(path, batch_size):
+    """Yield (ids, embeddings) views of at most `batch_size` rows of a shard."""
+    ids, embeddings = load_shard(path)
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size], embeddings[start:start + batch_size]
+
+
+def prefetch_shards(paths, prefetch=True):
+    """Yield (path, ids, embeddings) for each shard, loading the next shard in a
+    background thread while the current one is being indexed."""
+    if not prefetch:
+        for path in paths:
+            ids, embeddings = load_shard(path)
+            yield path, ids, embeddings
+        return
+    if not paths:
+        return
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(load_shard, paths[0])
+        for k, path in enumerate(paths):
+            ids, embeddings = future.result()
+            if k + 1 < len(paths):
+                future = executor.submit(load_shard, paths[k + 1])
+            yield path, ids, embeddings
+
+
+def index_shards(index, paths, batch_size, prefetch=True, exclude=None):
+    """Stream shards into `index` in batches of `batch_size` rows.
+
+    Whole batches are passed to the index as views of the shard. Only the tail
+    of a shard is copied, into a buffer that is reused across shards, so shards
+    are never concatenated. `exclude` maps a shard name to ids of rows to skip,
+    see superseded_ids. Returns the number of indexed rows.
+    """
+    buffer_ids, buffer = None, None
+    filled = 0
+    total = 0
+    start_time = time.time()
+
+    def flush():
+        nonlocal filled, total
+        if filled > 0:
+            index.index_data(buffer_ids[:filled], buffer[:filled])
+            total += filled
+            filled = 0
+
+    for path, ids, embeddings in prefetch_shards(paths, prefetch):
+        print(f"Loading file {path}")
+        ids = np.asarray(ids, dtype=np.int64)
+        stale = exclude.get(os.path.basename(path)) if exclude else None
+        if stale is not None and len(stale):
+            keep = ~np.isin(ids, stale)
+            ids, embeddings = ids[keep], embeddings[keep]
+        n = len(ids)
+        pos = 0
+        while pos < n:
+            if filled == 0 and n - pos >= batch_size:
+                index.index_data(ids[pos:pos + batch_size], embeddings[pos:pos + batch_size])
+                total += batch_size
+                pos += batch_size
+                continue
+            take = min(batch_size - filled, n - pos)
+            if buffer is None or len(buffer) < filled + take:
+                # grow up to batch_size rows so that small corpora never allocate a full batch
+                capacity = min(batch_size, max(filled + take, 2 * (0 if buffer is None else len(buffer))))
+                new_ids = np.empty((capacity,), dtype=np.int64)
+                new_buffer = np.empty((capacity, embeddings.shape[1]), dtype=np.float32)
+                if filled > 0:
+                    new_ids[:filled] = buffer_ids[:filled]
+                    new_buffer[:filled] = buffer[:filled]
+                buffer_ids, buffer = new_ids, new_buffer
+            buffer_ids[filled:filled + take] = ids[pos:pos + take]
+            buffer[filled:filled + take] = embeddings[pos:pos + take]
+            filled += take
+            pos += take
+            if filled == batch_size:
+                flush()
+    flush()
+
+    elapsed = max(time.time() - start_time, 1e-9)
+    print(f"Indexed {total} passages in {elapsed:.1f} s ({total / elapsed:.0f} rows/s).")
+    return total
+
+
+def passage_hash(passage):
+    content = json.dumps([passage.get("title"), passage.get("text")], ensure_ascii=False)
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+
+def read_passage_hashes(embeddings_dir):
+    path = os.path.join(embeddings_dir, HASHES_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as fin:
+        return json.load(fin)
+
+
+def write_passage_hashes(embeddings_dir, hashes):
+    tmp_file = os.path.join(embeddings_dir, HASHES_FILE + ".tmp")
+    with open(tmp_file, "w") as fout:
+        json.dump(hashes, fout)
+    os.replace(tmp_file, os.path.join(embeddings_dir, HASHES_FILE))
+
+
+def diff_passages(old_hashes, passages):
+    """Compare passages with the hashes of the last embedding run.
+
+    Returns (added, modified, removed, hashes) where the first three are lists of
+    ids and `hashes` describes `passages`.
+    """
+    hashes = {str(p["id"]): passage_hash(p) for p in passages}
+    added = [i for i in hashes if i not in old_hashes]
+    modified = [i for i in hashes if i in old_hashes and old_hashes[i] != hashes[i]]
+    removed = [i for i in old_hashes if i not in hashes]
+    return added, modified, removed, hashes
+
+
+def read_changelog(embeddings_dir):
+    path = os.path.join(embeddings_dir, CHANGELOG_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as fin:
+        return [json.loads(line) for line in fin if line.strip()]
+
+
+def append_changelog(embeddings_dir, entry):
+    with open(os.path.join(embeddings_dir, CHANGELOG_FILE), "a") as fout:
+        fout.write(json.dumps(entry) + "\n")
+        fout.flush()
+        os.fsync(fout.fileno())
+
+
+def superseded_ids(embeddings_dir):
+    """For each shard, the ids whose rows were replaced or removed by a later update.
+
+    Shards that are not in the changelog are the initial embedding run and are
+    superseded by every update.
+    """
+    changelog = read_changelog(embeddings_dir)
+    exclude = {}
+    stale = set()
+    for entry in reversed(changelog):
+        exclude[entry["shard"]] = np.array(sorted(stale), dtype=np.int64)
+        stale.update(int(i) for i in entry["added"] + entry["modified"] + entry["removed"])
+    stale = np.array(sorted(stale), dtype=np.int64)
+    for path in list_shards(os.path.join(embeddings_dir, "*")):
+        exclude.setdefault(os.path.basename(path), stale)
+    return exclude
+
+
+def apply_changelog(index, embeddings_dir, batch_size, prefetch=True):
+    """Bring an index up to date with the updates logged after index.meta["changelog_seq"].
+
+    Replaced and removed passages are dropped from the index before the shard of
+    each update is added, which needs an index built with id_map=True. Returns
+    the number of applied updates.
+    """
+    applied = 0
+    for entry in read_changelog(embeddings_dir):
+        if entry["seq"] <= index.meta.get("changelog_seq", 0):
+            continue
+        stale = [int(i) for i in entry["modified"] + entry["removed"]]
+        if stale:
+            index.remove_ids(stale)
+        index_shards(index, [os.path.join(embeddings_dir, entry["shard"])], batch_size, prefetch=prefetch)
+        index.meta["changelog_seq"] = entry["seq"]
+        applied += 1
+    return applied
+
+
+def _sampled_sha1(sha1, path, block_size):
+    """Feed the first, middle and last `block_size` bytes of a file to `sha1`."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as fin:
+        for offset in sorted({0, max(size // 2 - block_size // 2, 0), max(size - block_size, 0)}):
+            fin.seek(offset)
+            sha1.update(fin.read(block_size))
+    return size
+
+
+def shard_fingerprint(path, block_size=1 << 20):
+    """Size and hash of a shard, cheap enough to check at every start.
+
+    The header and the ids are hashed in full, the embeddings (or a legacy
+    pickle) only through blocks taken at the start, middle and end of the file.
+    """
+    sha1 = hashlib.sha1()
+    if is_mmap_shard(path):
+        size = 0
+        for name in [HEADER_FILE, IDS_FILE]:
+            with open(os.path.join(path, name), "rb") as fin:
+                content = fin.read()
+            sha1.update(content)
+            size += len(content)
+        size += _sampled_sha1(sha1, os.path.join(path, EMBEDDINGS_FILE), block_size)
+    else:
+        size = _sampled_sha1(sha1, path, block_size)
+    return {"name": os.path.basename(path), "size": size, "sha1": sha1.hexdigest()}
+
+
+def index_manifest(index, paths):
+    """Describe what `index` was built from, stored in index.meta["manifest"]."""
+    return {
+        "index_factory": index.index_factory,
+        "dim": int(index.index.d),
+        "count": int(index.index.ntotal),
+        "shards": [shard_fingerprint(path) for path in paths],
+    }
+
+
+def manifest_mismatch(manifest, index, paths, index_factory, dim, pending=()):
+    """Why a loaded `index` with `manifest` does not match the shards at `paths`
+    and the requested index type, or None if it can be used.
+
+    `pending` are the changelog entries still to be applied to the index; their
+    shards are not checked, and if they replace or remove passages the index must
+    be able to remove vectors.
+    """
+    if manifest is None:
+        return "it has no manifest"
+    if manifest["index_factory"] != index_factory:
+        return f"it is a {manifest['index_factory']} index, {index_factory} was requested"
+    if manifest["dim"] != dim:
+        return f"it has dimension {manifest['dim']}, {dim} was requested"
+    if manifest["count"] != index.index.ntotal:
+        return f"it holds {index.index.ntotal} vectors, {manifest['count']} were indexed"
+    if any(entry["modified"] or entry["removed"] for entry in pending) and not index.can_remove_ids():
+        return f"updates replace or remove passages, which this {index_factory} index cannot drop"
+    pending_shards = {entry["shard"] for entry in pending}
+    saved = {shard["name"]: shard for shard in manifest["shards"]}
+    names = set()
+    for path in paths:
+        name = os.path.basename(path)
+        names.add(name)
+        if name in pending_shards:
+            continue
+        if name not in saved:
+            return f"shard {name} is not indexed"
+        if shard_fingerprint(path) != saved[name]:
+            return f"shard {name} changed"
+    removed = sorted(set(saved) - names)
+    if removed:
+        return f"shard {removed[0]} was removed"
+    return None
+
+
+def load_saved_index(index, index_dir, embeddings_dir, paths, batch_size, mmap=False, save=True):
+    """Load the index saved in `index_dir` into `index`, a new Indexer of the requested
+    type, and apply the updates logged in `embeddings_dir` since it was saved.
+
+    Returns None when the index is ready, or why it no longer matches the shards
+    at `paths` and has to be rebuilt. With `save`, an updated index is written back.
+    """
+    index_factory, dim = index.index_factory, index.index.d
+    index.deserialize_from(index_dir, mmap=mmap)
+    pending = [e for e in read_changelog(embeddings_dir) if e["seq"] > index.meta.get("changelog_seq", 0)]
+    reason = manifest_mismatch(index.meta.get("manifest"), index, paths, index_factory, dim, pending=pending)
+    if reason is not None or not pending:
+        return reason
+    if mmap:
+        # a memory-mapped index is read-only
+        index.deserialize_from(index_dir)
+    try:
+        apply_changelog(index, embeddings_dir, batch_size)
+    except ValueError as e:
+        return str(e)
+    index.meta["manifest"] = index_manifest(index, paths)
+    if save:
+        index.serialize(index_dir)
+    return None
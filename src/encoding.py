@@ -0,0 +1,45 @@
+# Length-bucketed batching for the passage and query encoders.
+
+import numpy as np
+import torch
+
+
+def token_budget_batches(lengths, max_tokens, max_batch_size=None):
+    """Group positions of `lengths` into batches whose padded size stays within budget.
+
+    Positions are visited from the longest to the shortest text, so every batch
+    is padded to the length of its first element and holds at most
+    max_tokens // that length items (and at most `max_batch_size`).
+    """
+    order = np.argsort(-np.asarray(lengths), kind="stable")
+    batches, batch, padded_length = [], [], 0
+    for i in order.tolist():
+        if not batch:
+            padded_length = max(lengths[i], 1)
+        elif (len(batch) + 1) * padded_length > max_tokens or len(batch) == max_batch_size:
+            batches.append(batch)
+            batch = []
+            padded_length = max(lengths[i], 1)
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encode_texts(texts, model, tokenizer, maxlength, max_tokens, max_batch_size=None, device="cuda"):
+    """Embed `texts` in length-sorted batches and return them in the input order."""
+    tokenized = tokenizer(list(texts), max_length=maxlength, truncation=True, padding=False)
+    lengths = [len(x) for x in tokenized["input_ids"]]
+    embeddings = None
+    with torch.inference_mode():
+        for batch in token_budget_batches(lengths, max_tokens, max_batch_size):
+            features = [{k: v[i] for k, v in tokenized.items()} for i in batch]
+            encoded_batch = tokenizer.pad(features, padding=True, return_tensors="pt")
+            encoded_batch = {k: v.to(device) for k, v in encoded_batch.items()}
+            output = model(**encoded_batch).cpu()
+            if embeddings is None:
+                embeddings = torch.empty((len(lengths), output.shape[1]), dtype=output.dtype)
+            embeddings[torch.as_tensor(batch)] = output
+    if embeddings is None:
+        return np.empty((0, 0), dtype=np.float32)
+    return embeddings.numpy()
@@ -5,6 +5,8 @@
 # LICENSE file in the root directory of this source tree.
 
 import os
+import re
+import json
 import pickle
 from typing import List, Tuple
 
@@ -12,43 +14,132 @@ import faiss
 import numpy as np
 from tqdm import tqdm
 
+# legacy `mode` names, expressed as faiss index_factory strings
+INDEX_MODES = {
+    'simple': 'Flat',       ###暴力搜索
+    'hnsw': 'HNSW32',       ###hnsw搜索
+    'hclu': 'IVF50,Flat',   ###聚类搜索, 50个聚类中心
+}
+# search parameters the legacy modes used to hard-code
+DEFAULT_SEARCH_PARAMS = {
+    'hnsw': {'efConstruction': 32},
+    'hclu': {'nprobe': 5},  # 选择n个维诺空间进行索引
+}
+
+
+def default_train_sample_size(index_factory):
+    """Number of training vectors for IVF/PQ indexes, 64 per centroid or per PQ code."""
+    sizes = [64 * int(nlist) for nlist in re.findall(r'IVF(\d+)', index_factory)]
+    for nbits in re.findall(r'PQ\d+(?:x(\d+))?', index_factory):
+        sizes.append(64 * 2 ** int(nbits or 8))
+    return max(sizes) if sizes else 0
+
+
 class Indexer(object):
 
-    def __init__(self, vector_sz, n_subquantizers=0, n_bits=8,mode='simple'):
-        if n_subquantizers > 0:
-            self.index = faiss.IndexPQ(vector_sz, n_subquantizers, n_bits, faiss.METRIC_INNER_PRODUCT)
-        else:
-            if mode=='simple':
-            ###暴力搜索
-                self.index = faiss.IndexFlatIP(vector_sz)
-            elif mode=='hnsw': ###hnsw搜索
-                m=32
-                self.index = faiss.IndexHNSWFlat(vector_sz, m)
-                efConstruction = 32  # number of entry points used on each layer
-                # during construction
-                self.index.hnsw.efConstruction = efConstruction
-
-            elif mode=='hclu':
-            ###聚类搜索
-                nlist = 50  # 聚类中心个数
-                quantizer = faiss.IndexFlatL2(vector_sz)  # 量化器
-                self.index = faiss.IndexIVFFlat(quantizer,vector_sz,nlist, faiss.METRIC_L2)
-                self.index.nprobe = 5  # 选择n个维诺空间进行索引,
-        #self.index_id_to_db_id = np.empty((0), dtype=np.int64)
-        self.index_id_to_db_id = []
+    def __init__(self, vector_sz, n_subquantizers=0, n_bits=8, mode='simple', index_factory=None,
+                 ef_construction=None, train_sample_size=None, id_map=False):
+        if index_factory is None:
+            if n_subquantizers > 0:
+                index_factory = f'PQ{n_subquantizers}x{n_bits}'
+            else:
+                index_factory = INDEX_MODES[mode]
+        self.index_factory = index_factory
+        # inner product everywhere, matching the Contriever scores
+        self.index = faiss.index_factory(vector_sz, index_factory, faiss.METRIC_INNER_PRODUCT)
+        # with an id map faiss stores the passage ids itself, which allows removing them
+        self.id_map = id_map
+        if id_map and not _is_ivf(self.index):
+            # IVF indexes store ids natively, IndexIDMap2 would assume removal compacts them
+            self.index = faiss.IndexIDMap2(self.index)
+
+        params = dict(DEFAULT_SEARCH_PARAMS.get(mode, {})) if index_factory == INDEX_MODES.get(mode) else {}
+        if ef_construction is not None:
+            params['efConstruction'] = ef_construction
+        if 'efConstruction' in params:
+            hnsw = _find_hnsw(self.index)
+            if hnsw is not None:
+                hnsw.efConstruction = params.pop('efConstruction')
+        self.set_search_params(**params)
+
+        if train_sample_size is None:
+            train_sample_size = default_train_sample_size(index_factory)
+        self.train_sample_size = train_sample_size
+        # vectors received before the index could be trained
+        self._pending_ids, self._pending_embeddings = [], []
+        self.index_id_to_db_id = np.empty((0), dtype=np.int64)
+        # serialized next to the index, e.g. the last applied knowledge-base update
+        self.meta = {}
+
+    def set_search_params(self, ef_search=None, nprobe=None, **params):
+        """Tune search at runtime, e.g. efSearch for HNSW and nprobe for IVF."""
+        if ef_search is not None:
+            params['efSearch'] = ef_search
+        if nprobe is not None:
+            params['nprobe'] = nprobe
+        parameter_space = faiss.ParameterSpace()
+        for name, value in params.items():
+            try:
+                parameter_space.set_index_parameter(self.index, name, value)
+            except RuntimeError:
+                raise ValueError(f'{name} is not a search parameter of index {self.index_factory}')
 
     def index_data(self, ids, embeddings):
-        self._update_id_mapping(ids)
-        embeddings = embeddings.astype('float32')
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
         if not self.index.is_trained:
-            self.index.train(embeddings)
-        self.index.add(embeddings)
+            # callers may reuse their buffers, keep copies until there is enough data to train on
+            self._pending_ids.append(np.array(ids, dtype=np.int64))
+            self._pending_embeddings.append(np.array(embeddings))
+            if sum(len(x) for x in self._pending_ids) < self.train_sample_size:
+                return
+            self.train_pending()
+            return
+        if self.id_map:
+            self.index.add_with_ids(embeddings, np.ascontiguousarray(ids, dtype=np.int64))
+        else:
+            self._update_id_mapping(ids)
+            self.index.add(embeddings)
 
-        print(f'Total data indexed {len(self.index_id_to_db_id)}')
+        print(f'Total data indexed {self.index.ntotal}')
 
-    def search_knn(self, query_vectors: np.array, top_docs: int, index_batch_size: int = 2048) -> List[Tuple[List[object], List[float]]]:
-        query_vectors = query_vectors.astype('float32')
-        result = []
+    def can_remove_ids(self):
+        """Whether passages can be removed: the index must be ID-mapped and not HNSW-based."""
+        return self.id_map and _find_hnsw(self.index) is None
+
+    def remove_ids(self, db_ids):
+        """Remove passages by id. Only supported by ID-mapped indexes."""
+        if not self.id_map:
+            raise ValueError('Removing passages requires an index built with id_map=True')
+        self.train_pending()
+        db_ids = np.ascontiguousarray(db_ids, dtype=np.int64)
+        try:
+            return self.index.remove_ids(faiss.IDSelectorBatch(len(db_ids), faiss.swig_ptr(db_ids)))
+        except RuntimeError:
+            raise ValueError(f'Index {self.index_factory} does not support removing vectors')
+
+    def train_pending(self):
+        """Train the index on the buffered vectors, using at most train_sample_size of
+        them picked at random, then add all of them."""
+        if not self._pending_ids:
+            return
+        ids = np.concatenate(self._pending_ids)
+        embeddings = np.concatenate(self._pending_embeddings)
+        self._pending_ids, self._pending_embeddings = [], []
+        if not self.index.is_trained:
+            sample = embeddings
+            if 0 < self.train_sample_size < len(embeddings):
+                rng = np.random.default_rng(0)
+                sample = embeddings[np.sort(rng.choice(len(embeddings), self.train_sample_size, replace=False))]
+            print(f'Training index {self.index_factory} on {len(sample)} vectors')
+            self.index.train(sample)
+        self.index_data(ids, embeddings)
+
+    def search_knn(self, query_vectors: np.array, top_docs: int, index_batch_size: int = 2048) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (db_ids, scores), two (n_queries, top_docs) arrays. Missing hits have id -1."""
+        self.train_pending()
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+        db_ids = np.full((len(query_vectors), top_docs), -1, dtype=np.int64)
+        all_scores = np.zeros((len(query_vectors), top_docs), dtype=np.float32)
         nbatch = (len(query_vectors)-1) // index_batch_size + 1
         for k in tqdm(range(nbatch)):
             start_idx = k*index_batch_size
@@ -56,33 +147,79 @@ class Indexer(object):
             q = query_vectors[start_idx: end_idx]
             scores, indexes = self.index.search(q, top_docs)
             # convert to external ids
-            db_ids = [[str(self.index_id_to_db_id[i]) for i in query_top_idxs] for query_top_idxs in indexes]
-            result.extend([(db_ids[i], scores[i]) for i in range(len(db_ids))])
-        return result
+            if self.id_map:
+                db_ids[start_idx:end_idx] = indexes
+            else:
+                found = indexes >= 0
+                db_ids[start_idx:end_idx][found] = self.index_id_to_db_id[indexes[found]]
+            all_scores[start_idx:end_idx] = scores
+        return db_ids, all_scores
 
     def serialize(self, dir_path):
         index_file = os.path.join(dir_path, 'index.faiss')
-        meta_file = os.path.join(dir_path, 'index_meta.faiss')
+        meta_file = os.path.join(dir_path, 'index_meta.npy')
         print(f'Serializing index to {index_file}, meta data to {meta_file}')
+        self.train_pending()
 
         faiss.write_index(self.index, index_file)
-        with open(meta_file, mode='wb') as f:
-            pickle.dump(self.index_id_to_db_id, f)
+        np.save(meta_file, self.index_id_to_db_id)
+        with open(os.path.join(dir_path, 'index_meta.json'), 'w') as fout:
+            json.dump({'index_factory': self.index_factory, 'id_map': self.id_map, 'meta': self.meta}, fout)
 
-    def deserialize_from(self, dir_path):
+    def deserialize_from(self, dir_path, mmap=False):
+        """Load a serialized index. With `mmap` the index and the id mapping are
+        mapped read-only instead of read, so loading does not depend on their size."""
         index_file = os.path.join(dir_path, 'index.faiss')
-        meta_file = os.path.join(dir_path, 'index_meta.faiss')
+        meta_file = os.path.join(dir_path, 'index_meta.npy')
         print(f'Loading index from {index_file}, meta data from {meta_file}')
 
-        self.index = faiss.read_index(index_file)
-        print('Loaded index of type %s and size %d', type(self.index), self.index.ntotal)
+        self.index = None
+        if mmap:
+            try:
+                self.index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError:
+                print(f'Cannot memory-map {index_file}, reading it instead')
+        if self.index is None:
+            self.index = faiss.read_index(index_file)
+        print('Loaded index of type %s and size %d' % (type(self.index), self.index.ntotal))
+        self.id_map, self.meta = False, {}
+        if os.path.exists(os.path.join(dir_path, 'index_meta.json')):
+            with open(os.path.join(dir_path, 'index_meta.json')) as fin:
+                saved = json.load(fin)
+            self.id_map, self.meta = saved['id_map'], saved['meta']
+            self.index_factory = saved.get('index_factory', self.index_factory)
+        if self.id_map:
+            return
 
-        with open(meta_file, "rb") as reader:
-            self.index_id_to_db_id = pickle.load(reader)
+        if os.path.exists(meta_file):
+            self.index_id_to_db_id = np.load(meta_file, mmap_mode='r' if mmap else None)
+        else:
+            # indexes saved before the mapping was stored as .npy
+            with open(os.path.join(dir_path, 'index_meta.faiss'), "rb") as reader:
+                self.index_id_to_db_id = np.asarray(pickle.load(reader), dtype=np.int64)
         assert len(
             self.index_id_to_db_id) == self.index.ntotal, 'Deserialized index_id_to_db_id should match faiss index size'
 
     def _update_id_mapping(self, db_ids: List):
-        #new_ids = np.array(db_ids, dtype=np.int64)
-        #self.index_id_to_db_id = np.concatenate((self.index_id_to_db_id, new_ids), axis=0)
-        self.index_id_to_db_id.extend(db_ids)
\ No newline at end of file
+        new_ids = np.asarray(db_ids, dtype=np.int64)
+        self.index_id_to_db_id = np.concatenate((self.index_id_to_db_id, new_ids), axis=0)
+
+
+def _find_hnsw(index):
+    """Return the HNSW graph of `index`, looking through pre-transforms and IVF quantizers."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, (faiss.IndexPreTransform, faiss.IndexIDMap)):
+        return _find_hnsw(index.index)
+    if hasattr(index, 'hnsw'):
+        return index.hnsw
+    if isinstance(index, faiss.IndexIVF):
+        return _find_hnsw(index.quantizer)
+    return None
+
+
+def _is_ivf(index):
+    try:
+        faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return False
+    return True
@@ -0,0 +1,110 @@
+# Passages looked up by id straight from the JSONL/TSV file.
+#
+# Instead of parsing every passage into a dict, the store keeps two int64 arrays,
+# the sorted passage ids and the byte offset of each passage's line, and maps the
+# file into memory. The arrays are saved next to the passages as
+# <passages>.offsets.npz and rebuilt when the passages file changes.
+
+import os
+import io
+import csv
+import json
+import mmap
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+OFFSETS_SUFFIX = ".offsets.npz"
+
+
+def _parse_line(path, line):
+    """Parse one line of a passages file, None for the TSV header and blank lines."""
+    line = line.decode("utf-8")
+    if not line.strip():
+        return None
+    if path.endswith(".jsonl"):
+        return json.loads(line)
+    row = next(csv.reader(io.StringIO(line), delimiter="\t"))
+    if row[0] == "id":
+        return None
+    return {"id": row[0], "title": row[2], "text": row[1]}
+
+
+def build_offsets(path):
+    """Scan a passages file once. Returns (ids, offsets) sorted by id."""
+    ids, offsets = [], []
+    with open(path, "rb") as fin:
+        offset = 0
+        for line in fin:
+            passage = _parse_line(path, line)
+            if passage is not None:
+                try:
+                    ids.append(int(passage["id"]))
+                except ValueError:
+                    raise ValueError(f"Passage id {passage['id']!r} in {path} is not an integer")
+                offsets.append(offset)
+            offset += len(line)
+    ids = np.asarray(ids, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    # like a dict built over the file, the last line wins for duplicated ids
+    ids, last = np.unique(ids[::-1], return_index=True)
+    return ids, offsets[::-1][last]
+
+
+class PassageStore(object):
+    """Read-only mapping from passage id to passage dict, parsed on access."""
+
+    def __init__(self, path, offsets_path=None):
+        self.path = path
+        offsets_path = offsets_path or path + OFFSETS_SUFFIX
+        stat = os.stat(path)
+        self.ids, self.offsets = None, None
+        if os.path.exists(offsets_path):
+            saved = np.load(offsets_path)
+            if int(saved["size"]) == stat.st_size and int(saved["mtime_ns"]) == stat.st_mtime_ns:
+                self.ids, self.offsets = saved["ids"], saved["offsets"]
+        if self.ids is None:
+            logger.info(f"Building passage offsets for {path}")
+            self.ids, self.offsets = build_offsets(path)
+            try:
+                with open(offsets_path, "wb") as fout:
+                    np.savez(fout, ids=self.ids, offsets=self.offsets, size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            except OSError:
+                logger.warning(f"Cannot save passage offsets to {offsets_path}")
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b""
+        logger.info(f"Indexed {len(self.ids)} passages from {path}")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _position(self, passage_id):
+        passage_id = int(passage_id)
+        k = int(np.searchsorted(self.ids, passage_id))
+        if k < len(self.ids) and self.ids[k] == passage_id:
+            return k
+        return None
+
+    def __contains__(self, passage_id):
+        return self._position(passage_id) is not None
+
+    def __getitem__(self, passage_id):
+        k = self._position(passage_id)
+        if k is None:
+            raise KeyError(passage_id)
+        start = int(self.offsets[k])
+        end = self._mmap.find(b"\n", start)
+        return _parse_line(self.path, self._mmap[start:end if end >= 0 else len(self._mmap)])
+
+    def get(self, passage_id, default=None):
+        try:
+            return self[passage_id]
+        except KeyError:
+            return default
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
@@ -93,7 +93,8 @@ def init_distributed_mode(params):
         is_distributed = False
 
     # set GPU device
-    torch.cuda.set_device(params.local_rank)
+    if torch.cuda.is_available():
+        torch.cuda.set_device(params.local_rank)
 
     # initialize multi-GPU
     if is_distributed:
@@ -1,7 +1,26 @@
+import sys
+# the directory holding the robot package, so that the response cache is the
+# robot.LLM.llms.cache module the LLM/ scripts use
+sys.path.append("../..")
 import json
 import zhipuai
+from robot.LLM.llms.cache import default_cache
 
 
+def invoke_chatglm(prompt, model="chatglm_turbo", top_p=0.7, temperature=0.9):
+    """Ask chatglm through the response cache, so that reruns repeat no call."""
+    messages = [{"role": "user", "content": prompt}]
+
+    def invoke():
+        response = zhipuai.model_api.invoke(
+            model=model,
+            prompt=messages,
+            top_p=top_p,
+            temperature=temperature,
+        )
+        return response['data']['choices'][0]['content']
+
+    return default_cache().call(model, messages, {"top_p": top_p, "temperature": temperature}, invoke)
 
 
 def get_llm_chatglm_1():
@@ -19,13 +38,7 @@ def get_llm_chatglm_1():
     ex='Here are some examples.\nExample:'+'\n'.join(example)
     prompt=ins_0+'\n'+ins_1+'\n'+sen_1+'\n'+sen_2+'\n'+ex+'\n'+ins_2
 
-    response = zhipuai.model_api.invoke(
-            model="chatglm_turbo",
-            prompt=[{"role": "user", "content": prompt}],
-            top_p=0.7,
-            temperature=0.9,
-        )
-    return response['data']['choices'][0]['content']
+    return invoke_chatglm(prompt, top_p=0.7, temperature=0.9)
 
 def get_llm_chatglm_2(): #思维链表达VMD
     # your api key
@@ -39,13 +52,7 @@ def get_llm_chatglm_2(): #思维链表达VMD
 
     prompt=ins_0+'\n'+ins_1+'\n'+ins_2+'\n'+sen_1+'\n'+sen_2
 
-    response = zhipuai.model_api.invoke(
-            model="chatglm_turbo",
-            prompt=[{"role": "user", "content": prompt}],
-            top_p=0.7,
-            temperature=0.9,
-        )
-    return response['data']['choices'][0]['content']
+    return invoke_chatglm(prompt, top_p=0.7, temperature=0.9)
 
 def get_llm_chatglm_3(): #dot代替
     # your api key
@@ -61,13 +68,7 @@ def get_llm_chatglm_3(): #dot代替
 
     prompt=ins_0+'\n'+ins_1+'\n'+ins_2+'\n\n'+ins_3+'\n'+sen_1+'\n'+sen_2
 
-    response = zhipuai.model_api.invoke(
-            model="chatglm_turbo",
-            prompt=[{"role": "user", "content": prompt}],
-            top_p=0.7,
-            temperature=0.9,
-        )
-    return response['data']['choices'][0]['content']
+    return invoke_chatglm(prompt, top_p=0.7, temperature=0.9)
 
 
 if __name__=='__main__':
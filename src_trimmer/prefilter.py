@@ -0,0 +1,108 @@
+import numpy as np
+
+
+class ScorePrefilter(object):
+    """Decide confident (evidence, question) pairs locally, before the LLM is asked.
+
+    Pairs whose retrieval score (the Contriever `score` of the context) is at
+    least `accept` are judged similar, those at most `reject` dissimilar. With a
+    `cross_encoder` model name, the pairs left in between are scored by a
+    sentence-transformers CrossEncoder on CPU and decided by the `ce_accept` and
+    `ce_reject` bands. Whatever remains ambiguous goes to the LLM.
+
+    A reranker with one logit is scored by it. For a model with several (e.g. an
+    NLI cross-encoder), `ce_label` names the label or column index to score by,
+    and defaults to the model's "entailment" label.
+
+    A `holdout` share of the confident pairs, picked by key, is still sent to
+    the LLM to measure the agreement of the local decisions with it.
+    """
+
+    def __init__(self, accept=None, reject=None, cross_encoder=None, ce_accept=None, ce_reject=None,
+                 holdout=0.1, device="cpu", batch_size=32, ce_label=None):
+        self.accept = accept
+        self.reject = reject
+        self.ce_accept = ce_accept
+        self.ce_reject = ce_reject
+        self.holdout = holdout
+        self.batch_size = batch_size
+        self.model = None
+        if cross_encoder is not None:
+            try:
+                from sentence_transformers import CrossEncoder
+            except ImportError:
+                raise ImportError("The cross-encoder pre-filter needs sentence-transformers (pip install sentence-transformers)")
+            self.model = CrossEncoder(cross_encoder, device=device)
+            self.ce_column = self._score_column(self.model.config, ce_label)
+        # cross-encoder scores by pair key
+        self.ce_scores = {}
+
+    @staticmethod
+    def _score_column(config, label):
+        """Index of the logit used as the cross-encoder score."""
+        if config.num_labels == 1:
+            return 0
+        if isinstance(label, int):
+            if not 0 <= label < config.num_labels:
+                raise ValueError(f"ce_label {label} is not a column of a model with {config.num_labels} logits")
+            return label
+        labels = {str(name).lower(): int(column) for column, name in config.id2label.items()}
+        name = (label or "entailment").lower()
+        if name not in labels:
+            raise ValueError(
+                f"The cross-encoder has {config.num_labels} logits ({', '.join(labels)}), "
+                f"pass the label or column to score by as ce_label"
+            )
+        return labels[name]
+
+    @staticmethod
+    def _band(value, accept, reject):
+        if value is None:
+            return None
+        if accept is not None and value >= accept:
+            return True
+        if reject is not None and value <= reject:
+            return False
+        return None
+
+    def in_holdout(self, key):
+        return int(key[:8], 16) / 16 ** 8 < self.holdout
+
+    def decide_all(self, items):
+        """Decisions for a dict key -> (evidence, question, score), None when ambiguous."""
+        decisions = {key: self._band(score, self.accept, self.reject) for key, (_, _, score) in items.items()}
+        if self.model is not None:
+            ambiguous = [key for key, decision in decisions.items() if decision is None and key not in self.ce_scores]
+            for start in range(0, len(ambiguous), self.batch_size):
+                batch = ambiguous[start:start + self.batch_size]
+                scores = self.model.predict([(items[key][1], items[key][0]) for key in batch])
+                self.ce_scores.update(zip(batch, np.asarray(scores, dtype=float).reshape(len(batch), -1)[:, self.ce_column]))
+            for key, decision in decisions.items():
+                if decision is None and key in self.ce_scores:
+                    decisions[key] = self._band(self.ce_scores[key], self.ce_accept, self.ce_reject)
+        return decisions
+
+
+def calibrate_bands(scores, verdicts, precision=0.95, min_support=20):
+    """Score bands (accept, reject) reaching `precision` against LLM verdicts.
+
+    `accept` is the lowest score above which at least `precision` of the pairs
+    were judged similar, `reject` the highest score below which at least
+    `precision` were judged dissimilar. A band is None when no threshold covers
+    `min_support` pairs with that precision.
+    """
+    scores = np.asarray(scores, dtype=float)
+    verdicts = np.asarray(verdicts, dtype=bool)
+    order = np.argsort(-scores)
+    hits = np.cumsum(verdicts[order])
+    counts = np.arange(1, len(order) + 1)
+    ok = (hits / counts >= precision) & (counts >= min_support)
+    accept = float(scores[order][np.nonzero(ok)[0].max()]) if ok.any() else None
+
+    order = order[::-1]
+    misses = np.cumsum(~verdicts[order])
+    ok = (misses / counts >= precision) & (counts >= min_support)
+    reject = float(scores[order][np.nonzero(ok)[0].max()]) if ok.any() else None
+    if accept is not None and reject is not None and accept <= reject:
+        return None, None
+    return accept, reject
@@ -1,9 +1,18 @@
 import sys
 sys.path.append("..")
+import os
+import time
+import hashlib
+import inspect
+import sqlite3
+import threading
+import concurrent.futures
 import torch
 import json
 import matplotlib.pyplot as plt
 import zhipuai
+from prefilter import ScorePrefilter
+from llm import invoke_chatglm
 
 
 
@@ -27,13 +36,7 @@ def get_llm_chatglm(evi,query):
     zhipuai.api_key = "1b63a16cb13959ca1abf3a3fededa2a2.IYPOsV0KXyuXyle7"
     ins='Pretend that you are a language learning assistant. Are the following statements similar with the question? Just Say True if they are; otherwise just say False. Only output one word.'
     prompt=ins+'\n'+evi+'\n'+query
-    response = zhipuai.model_api.invoke(
-            model="chatglm_turbo",
-            prompt=[{"role": "user", "content": prompt}],
-            top_p=0.7,
-            temperature=0.9,
-        )
-    return response['data']['choices'][0]['content']
+    return invoke_chatglm(prompt, top_p=0.7, temperature=0.9)
 def get_llm_chatglm_0(evi,query): #思维链表达VMD
     # your api key
     #print("llm!")
@@ -47,13 +50,7 @@ def get_llm_chatglm_0(evi,query): #思维链表达VMD
     ins_2=rule_1
     prompt=ins_0+'\n'+ins_1+'\n'+ins_2+'\n\n'+ins_3+'\n'+evi+'\n'+query
 
-    response = zhipuai.model_api.invoke(
-            model="chatglm_turbo",
-            prompt=[{"role": "user", "content": prompt}],
-            top_p=0.7,
-            temperature=0.9,
-        )
-    return response['data']['choices'][0]['content']
+    return invoke_chatglm(prompt, top_p=0.7, temperature=0.9)
 
 def context_relation(t_context_result,f_context_result):
     r=[]
@@ -62,35 +59,165 @@ def context_relation(t_context_result,f_context_result):
             r.append((idx,idy))
     return r
 
-def get_enquery(file_path):
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+
+def judge_fingerprint(judge):
+    """Name and source hash of a judge function, which change with its prompt or model."""
+    try:
+        source = inspect.getsource(judge)
+    except (OSError, TypeError):
+        source = ""
+    name = getattr(judge, "__qualname__", type(judge).__name__)
+    return name + ":" + hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+
+
+class JudgmentEngine(object):
+    """Similarity verdicts for (evidence, question) pairs.
+
+    Pairs are deduplicated on the evidence text and the normalized question, so
+    a passage retrieved for several near-identical questions is judged once.
+    Verdicts are persisted in sqlite and reused by later runs, the remaining
+    pairs are sent concurrently through a bounded pool and failed calls are
+    retried with exponential backoff. An optional `prefilter` (see
+    prefilter.ScorePrefilter) decides confident pairs without the LLM.
+
+    Verdicts are keyed by `judge_id` too, the judge_fingerprint of the judge by
+    default, so those of another judge prompt or model are not reused.
+    """
+
+    def __init__(self, path="relation_context/verdicts.sqlite", max_workers=8, max_retries=3, backoff=1.0, judge=None,
+                 prefilter=None, judge_id=None):
+        self.judge = judge or get_llm_chatglm_0
+        self.judge_id = judge_id or judge_fingerprint(self.judge)
+        self.prefilter = prefilter
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS verdicts (key TEXT PRIMARY KEY, verdict INTEGER, response TEXT)")
+        self.db.commit()
+        self.stats = {}
+        self.scored_verdicts = []
+
+    def key(self, evidence, question):
+        return hashlib.sha1(
+            (self.judge_id + "\n" + evidence + "\n" + normalize_question(question)).encode("utf-8")
+        ).hexdigest()
+
+    def _lookup(self, keys):
+        verdicts = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.db.execute(
+                f"SELECT key, verdict FROM verdicts WHERE key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            verdicts.update((key, bool(verdict)) for key, verdict in rows)
+        return verdicts
+
+    def _store(self, key, verdict, response):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)", (key, int(verdict), response))
+            self.db.commit()
+
+    def _ask(self, evidence, question):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return self.judge(evidence, question)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def judge_all(self, pairs):
+        """Verdicts for a list of (evidence, question, retrieval score) pairs, by key.
+        Pairs whose calls still fail after the retries are left out."""
+        unique = {}
+        for evidence, question, score in pairs:
+            unique.setdefault(self.key(evidence, question), (evidence, question, score))
+        verdicts = self._lookup(unique)
+        decisions = self.prefilter.decide_all(unique) if self.prefilter is not None else {}
+        # confident pairs skip the LLM, except the held-out ones that measure the pre-filter
+        prefiltered = {
+            key: decision for key, decision in decisions.items()
+            if decision is not None and key not in verdicts and not self.prefilter.in_holdout(key)
+        }
+        pending = {key: pair[:2] for key, pair in unique.items() if key not in verdicts and key not in prefiltered}
+
+        failed = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._ask, *pair): key for key, pair in pending.items()}
+            for future in concurrent.futures.as_completed(futures):
+                key = futures[future]
+                try:
+                    response = future.result()
+                except Exception as e:
+                    print(f"Judgment failed after {self.max_retries} retries: {e}")
+                    failed += 1
+                    continue
+                verdicts[key] = "True" in response
+                self._store(key, verdicts[key], response)
+
+        # LLM verdicts, stored or fresh, that the pre-filter also decided
+        compared = [key for key, decision in decisions.items() if decision is not None and key in verdicts]
+        agreed = sum(decisions[key] == verdicts[key] for key in compared)
+        # (retrieval score, LLM verdict) pairs, to calibrate the bands with prefilter.calibrate_bands
+        self.scored_verdicts = [(unique[key][2], verdicts[key]) for key in unique
+                                if key in verdicts and unique[key][2] is not None]
+        verdicts.update(prefiltered)
+
+        self.stats = {
+            "pairs": len(pairs),
+            "unique": len(unique),
+            "stored": len(unique) - len(pending) - len(prefiltered),
+            "called": len(pending),
+            "calls_avoided": len(prefiltered),
+            "failed": failed,
+        }
+        if self.prefilter is not None:
+            self.stats["compared"] = len(compared)
+            self.stats["agreement"] = agreed / len(compared) if compared else None
+        print(f"Judgments: {self.stats}")
+        return verdicts
+
+
+def get_enquery(file_path, engine=None):
     ctxs,query=get_ctxs_em(file_path)
+    engine = engine or JudgmentEngine()
+    # collect every (evidence, question) pair first, so that they are deduplicated across queries
+    pairs = []
+    for i in range(len(ctxs)):
+        for j, ctx in enumerate(ctxs[i]):
+            score = float(ctx["score"]) if "score" in ctx else None
+            pairs.append((i, j, ctx["title"] + "\n" + ctx["text"], query[i], score))
+    verdicts = engine.judge_all([(evidence, q, score) for _, _, evidence, q, score in pairs])
+
     unsim_s=[]
     error_d=[]
-    for i in range(len(ctxs)):
-        t_context_result={"id":[],"result":[]}
-        f_context_result={"id":[],"result":[]}
-        evidences = ["[{}] ".format(i+1) + ctx["title"]+"\n" + ctx["text"] for i, ctx in enumerate(ctxs[i])]
-        q=query[i]
-        #for j in range(10):
-        for j in range(len(ctxs[i])):
-            try:
-                r=get_llm_chatglm_0(evidences[j],q)
-            except:
-                error_d.append((i,j))
-                continue
-            if "True" in r:
-                t_context_result['result'].append(r)
-                t_context_result['id'].append(int(ctxs[i][j]['id']))
-            else:
-                f_context_result['result'].append(r)
-                f_context_result['id'].append(int(ctxs[i][j]['id']))
+    results = [({"id":[],"result":[]}, {"id":[],"result":[]}) for _ in ctxs]
+    for i, j, evidence, q, _ in pairs:
+        t_context_result, f_context_result = results[i]
+        verdict = verdicts.get(engine.key(evidence, q))
+        if verdict is None:
+            error_d.append((i,j))
+        elif verdict:
+            t_context_result['result'].append(verdict)
+            t_context_result['id'].append(int(ctxs[i][j]['id']))
+        else:
+            f_context_result['result'].append(verdict)
+            f_context_result['id'].append(int(ctxs[i][j]['id']))
+    for t_context_result, f_context_result in results:
         unsim=context_relation(t_context_result,f_context_result)
         print(unsim)
         unsim_s.append(unsim)
     return unsim_s,error_d
 
-def f_main(file_path,rel_path):
-    relation_c,error_d = get_enquery(file_path)
+def f_main(file_path,rel_path,prefilter=None):
+    relation_c,error_d = get_enquery(file_path, JudgmentEngine(prefilter=prefilter))
     print(len(relation_c))
     json_data = json.dumps(relation_c)
     json_data_1 = json.dumps(error_d)
@@ -100,7 +227,9 @@ def f_main(file_path,rel_path):
 
 if __name__=='__main__':
     file_path = "../robot_retr_result/medium_instr_goal.jsonl"
-    relation_c, error_d = get_enquery(file_path)
+    # e.g. ScorePrefilter(accept=1.6, reject=0.9, cross_encoder="cross-encoder/ms-marco-MiniLM-L-6-v2", ce_accept=5, ce_reject=-5)
+    prefilter = None
+    relation_c, error_d = get_enquery(file_path, JudgmentEngine(prefilter=prefilter))
     print(len(relation_c))
     json_data = json.dumps(relation_c)
     json_data_1 = json.dumps(error_d)
@@ -24,71 +24,68 @@ import src.contriever
 import src.utils
 import src.slurm
 import src.data
+import src.embedding_shards
+import src.embedding_cache
+import src.encoding
+import src.passage_store
 from src.evaluation import calculate_matches
 import src.normalize_text
 
 os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 
-def embed_queries(args, queries, model, tokenizer):
+def embed_queries(args, queries, model, tokenizer, cache=None):
     model.eval()
-    embeddings, batch_question = [], []
-    with torch.no_grad():
-        for k, q in enumerate(queries):
-            if args.lowercase:
-                q = q.lower()
-            if args.normalize_text:
-                q = src.normalize_text.normalize(q)
-            batch_question.append(q)
-
-            if len(batch_question) == args.per_gpu_batch_size or k == len(queries) - 1:
-
-                encoded_batch = tokenizer.batch_encode_plus(
-                    batch_question,
-                    return_tensors="pt",
-                    max_length=args.question_maxlength,
-                    padding=True,
-                    truncation=True,
-                )
-                encoded_batch = {k: v.cuda() for k, v in encoded_batch.items()}
-                output = model(**encoded_batch)
-                embeddings.append(output.cpu())
-
-                batch_question = []
-
-    embeddings = torch.cat(embeddings, dim=0)
-    print(f"Questions embeddings shape: {embeddings.size()}")
-
-    return embeddings.numpy()
-
-
-def index_encoded_data(index, embedding_files, indexing_batch_size):
-    allids = []
-    allembeddings = np.array([])
-    for i, file_path in enumerate(embedding_files):
-        print(f"Loading file {file_path}")
-        with open(file_path, "rb") as fin:
-            ids, embeddings = pickle.load(fin)
-
-        allembeddings = np.vstack((allembeddings, embeddings)) if allembeddings.size else embeddings
-        allids.extend(ids)
-        while allembeddings.shape[0] > indexing_batch_size:
-            allembeddings, allids = add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-    while allembeddings.shape[0] > 0:
-        allembeddings, allids = add_embeddings(index, allembeddings, allids, indexing_batch_size)
-
-    print("Data indexing completed.")
-
-
-def add_embeddings(index, embeddings, ids, indexing_batch_size):
-    end_idx = min(indexing_batch_size, embeddings.shape[0])
-    ids_toadd = ids[:end_idx]
-    embeddings_toadd = embeddings[:end_idx]
-    ids = ids[end_idx:]
-    embeddings = embeddings[end_idx:]
-    index.index_data(ids_toadd, embeddings_toadd)
-    return embeddings, ids
+    processed = []
+    for q in queries:
+        if args.lowercase:
+            q = q.lower()
+        if args.normalize_text:
+            q = src.normalize_text.normalize(q)
+        processed.append(q)
+
+    embeddings = [None] * len(processed)
+    if cache is not None:
+        for k, q in enumerate(processed):
+            embeddings[k] = cache.get(q)
+    # encode every distinct query missing from the cache once
+    missing = list(dict.fromkeys(q for q, e in zip(processed, embeddings) if e is None))
+
+    if missing:
+        encoded = src.encoding.encode_texts(
+            missing,
+            model,
+            tokenizer,
+            args.question_maxlength,
+            args.per_gpu_batch_size * args.question_maxlength,
+            device=args.device,
+        )
+        if cache is not None:
+            cache.put_many(missing, encoded)
+        encoded = dict(zip(missing, encoded))
+        embeddings = [encoded[q] if e is None else e for q, e in zip(processed, embeddings)]
+
+    embeddings = np.stack(embeddings)
+    print(f"Questions embeddings shape: {embeddings.shape}")
+
+    return embeddings
+
+
+def index_encoded_data(index, embedding_files, indexing_batch_size, prefetch=True, exclude=None):
+    src.embedding_shards.index_shards(index, embedding_files, indexing_batch_size, prefetch=prefetch, exclude=exclude)
+
+
+def new_index(args):
+    return src.index.Indexer(
+        args.projection_size,
+        args.n_subquantizers,
+        args.n_bits,
+        mode=args.index_mode,
+        index_factory=args.index_factory,
+        ef_construction=args.ef_construction,
+        train_sample_size=args.train_sample_size,
+        id_map=args.id_map,
+    )
 
 
 def validate(data, workers_num):
@@ -107,21 +104,18 @@ def validate(data, workers_num):
 
 def add_passages(data, passages, top_passages_and_scores):
     # add passages to original data
-    merged_data = []
-    assert len(data) == len(top_passages_and_scores)
+    top_ids, top_scores = top_passages_and_scores
+    assert len(data) == len(top_ids)
     for i, d in enumerate(data):
-        results_and_scores = top_passages_and_scores[i]
-        docs = [passages[int(doc_id)] for doc_id in results_and_scores[0]]
-        scores = [str(score) for score in results_and_scores[1]]
-        ctxs_num = len(docs)
         d["ctxs"] = [
             {
-                "id": results_and_scores[0][c],
-                "title": docs[c]["title"],
-                "text": docs[c]["text"],
-                "score": scores[c],
+                "id": str(doc_id),
+                "title": passages[doc_id]["title"],
+                "text": passages[doc_id]["text"],
+                "score": str(score),
             }
-            for c in range(ctxs_num)
+            for doc_id, score in zip(top_ids[i].tolist(), top_scores[i])
+            if doc_id >= 0
         ]
 
 
@@ -166,6 +160,8 @@ def main(data_path,rewrite_path):
         "--validation_workers", type=int, default=32, help="Number of parallel processes to validate results"
     )
     parser.add_argument("--per_gpu_batch_size", type=int, default=64, help="Batch size for question encoding")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Number of queries retrieved and written at a time")
+    parser.add_argument("--resume", action="store_true", help="keep the results already in the output files and continue after them")
     parser.add_argument(
         "--save_index", action="store_true", help="If enabled, save index"
     )
@@ -179,6 +175,9 @@ def main(data_path,rewrite_path):
         "--model_name_or_path", type=str, help="path to directory containing model weights and config file"
     )
     parser.add_argument("--no_fp16", action="store_true", help="inference in fp32")
+    parser.add_argument("--device", type=str, default="auto", help="cuda, cuda:N, cpu, or auto to pick cuda when available")
+    parser.add_argument("--quantize", action="store_true", help="apply dynamic int8 quantization to the encoder on CPU")
+    parser.add_argument("--num_threads", type=int, default=None, help="number of intra-op threads on CPU")
     parser.add_argument("--question_maxlength", type=int, default=512, help="Maximum number of tokens in a question")
     parser.add_argument(
         "--indexing_batch_size", type=int, default=1000000, help="Batch size of the number of passages indexed"
@@ -191,10 +190,34 @@ def main(data_path,rewrite_path):
         help="Number of subquantizer used for vector quantization, if 0 flat index is used",
     )
     parser.add_argument("--n_bits", type=int, default=8, help="Number of bits per subquantizer")
+    parser.add_argument(
+        "--index_mode", type=str, default="simple", choices=["simple", "hnsw", "hclu"], help="Preset index type, ignored if --index_factory is set"
+    )
+    parser.add_argument(
+        "--index_factory", type=str, default=None, help="faiss index_factory string, e.g. Flat, HNSW32, IVF4096,Flat, OPQ64,IVF4096,PQ64"
+    )
+    parser.add_argument("--ef_construction", type=int, default=None, help="HNSW construction depth")
+    parser.add_argument("--ef_search", type=int, default=None, help="HNSW search depth, higher is slower and more accurate")
+    parser.add_argument("--nprobe", type=int, default=None, help="Number of IVF lists visited per query")
+    parser.add_argument(
+        "--mmap_index", action="store_true", help="memory-map the saved index instead of reading it"
+    )
+    parser.add_argument(
+        "--id_map",
+        action="store_true",
+        help="store passage ids in the index so that incremental updates can replace passages",
+    )
+    parser.add_argument(
+        "--train_sample_size", type=int, default=None, help="Number of vectors used to train IVF/PQ indexes (default: 64 per centroid)"
+    )
     parser.add_argument("--lang", nargs="+")
     parser.add_argument("--dataset", type=str, default="none")
     parser.add_argument("--lowercase", action="store_true", help="lowercase text before encoding")
     parser.add_argument("--normalize_text", action="store_true", help="normalize text")
+    parser.add_argument(
+        "--query_cache_size", type=int, default=10000, help="Number of query embeddings kept in memory, 0 disables the cache"
+    )
+    parser.add_argument("--query_cache_path", type=str, default=None, help="sqlite file persisting the query embedding cache")
 
     args = parser.parse_args()
 
@@ -211,65 +234,92 @@ def main(data_path,rewrite_path):
     #args.load_index = True
     args.index_path = '../index_hnsw/'
     print(f"Loading model from: {args.model_name_or_path}")
+    args.device = src.contriever.resolve_device(args.device)
     model, tokenizer, _ = src.contriever.load_retriever(args.model_name_or_path)
-    model.eval()
-    model = model.cuda()
-    if not args.no_fp16:
-        model = model.half()
+    model = src.contriever.prepare_retriever(
+        model, args.device, fp16=not args.no_fp16, quantize=args.quantize, num_threads=args.num_threads
+    )
 
-    index = src.index.Indexer(args.projection_size, args.n_subquantizers, args.n_bits, mode='simple')
-    #efSearch = 1500
-    #index.index.hnsw.efSearch = efSearch
+    index = new_index(args)
 
     # index all passages
-    input_paths = glob.glob(args.passages_embeddings)
-    input_paths = sorted(input_paths)
+    input_paths = src.embedding_shards.list_shards(args.passages_embeddings)
+    embeddings_dir = os.path.dirname(input_paths[0])
     index_path = os.path.join(args.index_path)
-    if args.load_index and os.path.exists(index_path):
-        index.deserialize_from(index_path)
-    else:
+    loaded = False
+    if args.load_index and os.path.exists(os.path.join(index_path, "index.faiss")):
+        reason = src.embedding_shards.load_saved_index(
+            index, index_path, embeddings_dir, input_paths, args.indexing_batch_size,
+            mmap=args.mmap_index, save=args.save_index,
+        )
+        if reason is not None:
+            print(f"Rebuilding the index: {reason}.")
+            index = new_index(args)
+        else:
+            loaded = True
+    if not loaded:
         print(f"Indexing passages from files {input_paths}")
         start_time_indexing = time.time()
-        index_encoded_data(index, input_paths, args.indexing_batch_size)
+        index_encoded_data(
+            index, input_paths, args.indexing_batch_size, exclude=src.embedding_shards.superseded_ids(embeddings_dir)
+        )
+        index.train_pending()
+        changelog = src.embedding_shards.read_changelog(embeddings_dir)
+        index.meta["changelog_seq"] = changelog[-1]["seq"] if changelog else 0
+        index.meta["manifest"] = src.embedding_shards.index_manifest(index, input_paths)
         print(f"Indexing time: {time.time()-start_time_indexing:.1f} s.")
         if args.save_index:
             index.serialize(index_path)
+    index.set_search_params(ef_search=args.ef_search, nprobe=args.nprobe)
+
 
+    query_cache = src.embedding_cache.QueryEmbeddingCache.from_args(args)
 
-    # load passages
-    passages = src.data.load_passages(args.passages)
-    passage_id_map = {x["id"]: x for x in passages}
+    # passages are read from the file when they are retrieved
+    passages = src.passage_store.PassageStore(args.passages)
 
     data_paths = glob.glob(args.data)
     query_path=rewrite_path
 
     for path in data_paths:
-        queries = load_data(query_path)[0]
-        #print(queries)
-        data = load_data(path)
         output_path = os.path.join(args.output_dir, os.path.basename(path))
-        #for i in range(len(data)):
-        #    data[i]['question']=queries[i]
-        questions_embedding = embed_queries(args, queries, model, tokenizer)
-        #print("embed")
-
-        # get top k results
-        start_time_retrieval = time.time()
-        top_ids_and_scores = index.search_knn(questions_embedding, args.n_docs)
-        #simple_scores=index2.search_knn(questions_embedding, args.n_docs)
-        print(f"Search time: {time.time()-start_time_retrieval:.1f} s.")
-
-        add_passages(data, passage_id_map, top_ids_and_scores)
-        #hasanswer = validate(data, args.validation_workers)
-        #add_hasanswer(data, hasanswer)
         os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        with open(output_path, "w", encoding='utf-8') as fout:
-            for ex in data:
-                json.dump(ex, fout, ensure_ascii=False)
-                fout.write("\n")
+        done = src.data.resume_jsonl(output_path) if args.resume else 0
+        if done > 0:
+            print(f"Resuming {output_path} after {done} queries")
+        search_time = 0.0
+        # retrieve and write chunk by chunk, the rewritten queries (one per line, see
+        # vmdit_rewrite.write_queries) are read along, aligned with the data lines
+        query_chunks = src.data.iter_data_chunks(query_path, args.chunk_size, skip=done)
+        with open(output_path, "a" if done > 0 else "w", encoding='utf-8') as fout:
+            for data in src.data.iter_data_chunks(path, args.chunk_size, skip=done):
+                #for i in range(len(data)):
+                #    data[i]['question']=queries[i]
+                chunk_queries = next(query_chunks, [])
+                if len(chunk_queries) != len(data):
+                    raise ValueError(f"{query_path} has fewer rewritten queries than {path} has examples")
+                questions_embedding = embed_queries(args, chunk_queries, model, tokenizer, cache=query_cache)
+                #print("embed")
+
+                # get top k results
+                start_time_retrieval = time.time()
+                top_ids_and_scores = index.search_knn(questions_embedding, args.n_docs)
+                #simple_scores=index2.search_knn(questions_embedding, args.n_docs)
+                search_time += time.time() - start_time_retrieval
+
+                add_passages(data, passages, top_ids_and_scores)
+                #hasanswer = validate(data, args.validation_workers)
+                #add_hasanswer(data, hasanswer)
+                for ex in data:
+                    json.dump(ex, fout, ensure_ascii=False)
+                    fout.write("\n")
+                fout.flush()
+                done += len(data)
+        if query_cache is not None:
+            print(query_cache.report())
+        print(f"Search time: {search_time:.1f} s.")
         print(f"Saved results to {output_path}")
 
-
 if __name__ == "__main__":
     data_path = '../robot_retr_result/medium_instr_goal.jsonl'
     rewrite_path= 'new_query/n_medium.jsonl'
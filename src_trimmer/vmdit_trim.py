@@ -1,15 +1,54 @@
 import json
+import numpy as np
 
-def read_rel(file_path):
-    relation=[]
+def read_rel(file_path, per_query=False):
+    """Relation pairs (idx, idy): idy is dropped when idx is retrieved before it.
+    Returns one set shared by all queries, or with `per_query` one set per query."""
+    relation=set()
+    relations=[]
     with open(file_path, "r", encoding='utf-8') as fin:
         for k,example in enumerate(fin):
             example = json.loads(example)
             for x in example:
-                for y in x:
-                    relation.append(y)
+                pairs = {(int(y[0]), int(y[1])) for y in x}
+                relation |= pairs
+                relations.append(pairs)
     #print(len(relation))
-    return relation
+    return relations if per_query else relation
+
+def drop_ids(ids, rel):
+    """Ids of the contexts that come after a context they are related to, O(k^2) set lookups."""
+    del_id=set()
+    l=len(ids)
+    for i in range(l):
+        idx=ids[i]
+        for j in range(i+1,l):
+            idy=ids[j]
+            if (idx,idy) in rel:
+                del_id.add(idy)
+    return del_id
+
+def pair_keys(idx, idy):
+    return (np.asarray(idx, dtype=np.int64) << 32) | np.asarray(idy, dtype=np.int64)
+
+def dropped_mask(all_ids, rel):
+    """Vectorized drop_ids for all queries at once, against the shared relation set.
+    Returns a boolean (n_queries, max_k) mask of the contexts to drop."""
+    k = max((len(ids) for ids in all_ids), default=0)
+    ids = np.full((len(all_ids), k), -1, dtype=np.int64)
+    for q, row in enumerate(all_ids):
+        ids[q, :len(row)] = row
+    valid = ids >= 0
+    if not rel or k == 0:
+        return np.zeros(ids.shape, dtype=bool)
+    rel_keys = np.unique(pair_keys(*np.array(sorted(rel), dtype=np.int64).T))
+    keys = pair_keys(ids[:, :, None], ids[:, None, :])
+    later = np.triu(np.ones((k, k), dtype=bool), 1)
+    related = np.isin(keys, rel_keys) & later & valid[:, :, None] & valid[:, None, :]
+    dropped = related.any(axis=1)
+    # like the id list, a dropped id removes every context with that id
+    same_id = (ids[:, :, None] == ids[:, None, :]) & valid[:, None, :]
+    return (same_id & dropped[:, None, :]).any(axis=2) & valid
 
 def read_evi(file_path):
     ids=[]
@@ -23,25 +62,23 @@ def read_evi(file_path):
             ids.append([int(x['id']) for x in example['ctxs']])
     return ids,ctxs,query
 
-def get_context(rel_path,file_path):
-    rel=read_rel(rel_path)
+def get_context(rel_path,file_path,per_query=False):
+    rel=read_rel(rel_path, per_query)
     #print(rel)
     all_ids,all_ctxs,query=read_evi(file_path)
+    if not per_query:
+        mask=dropped_mask(all_ids,rel)
     result=[]
     for x in range(len(all_ctxs)):
-        ids=all_ids[x]
-        del_id=[]
-        l=len(ids)
-        for i in range(l):
-            idx=ids[i]
-            for j in range(i+1,l):
-                idy=ids[j]
-                if [idx,idy] in rel:
-                    del_id.append(idy)
+        if per_query:
+            del_id=drop_ids(all_ids[x],rel[x] if x < len(rel) else set())
+            keep=[int(ct['id']) not in del_id for ct in all_ctxs[x]]
+        else:
+            keep=~mask[x]
         #print("del",del_id)
         evidence=[]
-        for ct in all_ctxs[x][:30]:
-            if int(ct['id']) not in del_id:
+        for ct, kept in zip(all_ctxs[x][:30], keep):
+            if kept:
                 ct= ct["title"] + "\n" + ct["text"]
                 evidence.append(ct)
         print("l evi:",len(evidence))
@@ -53,7 +90,6 @@ def get_context(rel_path,file_path):
     return result
 
 
-
 if __name__=='__main__':
     rel_path = "relation_context/L2/relation_context_medium.json"
     #file_path= "retr_result/L2/medium_instr_goal.jsonl"